@@ -1,65 +1,94 @@
-
+import os
 import logging
-from flask import Flask
-from dotenv import load_dotenv
+import importlib
 import threading
-import os
-from sqlalchemy import create_engine
-from run_bots import run_bots
-from update_database import update_database
-from ping_telegram import ping_telegram
+from dotenv import load_dotenv
+from flask import Flask, Response, jsonify, request
+from job_runner import JobRunner
+import metrics
 
 
 app = Flask(__name__)
 
 logging.basicConfig(level=logging.INFO)
 
+load_dotenv()
 
-@app.route('/')
-def home():
-    # Trigger your main task in a separate thread
-    threading.Thread(target=main).start()
-    return "Task started", 200
 
+def lazy_stage(module):
+    # Stage modules pull in pandas, numpy and friends, importing them on first run keeps startup fast
+    def stage():
+        return getattr(importlib.import_module(module), module)()
+    return stage
 
-def main():
 
-    logging.info(f"-----*----------*----------*-----")
-    logging.info(f"Starting task.")
+# One process-wide runner, stages share the pool from db.get_engine
+runner = JobRunner([
+    ("update_database", lazy_stage("update_database")),
+    ("run_bots", lazy_stage("run_bots")),
+    ("ping_telegram", lazy_stage("ping_telegram")),
+], profile_dir=os.environ.get('profiledir', 'profiles'))
 
+# Capture every run with cProfile, single runs can ask for it with /?profile=1
+profile_runs = os.environ.get('profileruns', '').lower() in ('1', 'true', 'yes')
 
 
+@app.route('/')
+def home():
+    # Trigger the main task in the background, joining a run already in flight
+    profile = profile_runs or request.args.get('profile', '').lower() in ('1', 'true', 'yes')
+    started, _ = runner.trigger(profile=profile)
+    if started:
+        return "Task started", 200
+    return "Task already running", 200
+
+
+@app.route('/status')
+def status():
+    return jsonify(runner.status()), 200
+
+
+def query_route(respond):
+    # Imported on first request, like the stages
+    query_api = importlib.import_module("query_api")
+    from db import get_engine
+    global query_cache
+    # Flask serves requests on threads, the first ones must not each build a cache
+    with query_cache_lock:
+        if query_cache is None:
+            query_cache = query_api.ResponseCache(
+                max_bytes=int(os.environ.get('querycachemb', 64)) * 1024 * 1024,
+                ttl=float(os.environ.get('querycachettl', 300)),
+            )
     try:
-        logging.info(f"Trying to update database...")
-        update_database()
-    except Exception as e:
-        logging.error(f"PYTHON ERROR: {e}")
-    
-    logging.info(f"Database updated.")
+        body, mimetype = getattr(query_api, respond)(get_engine(), query_cache, request.args)
+    except query_api.QueryError as e:
+        return jsonify({"error": str(e)}), 400
+    return Response(body, mimetype=mimetype)
 
 
+query_cache = None
+query_cache_lock = threading.Lock()
 
-    try:
-        logging.info(f"Trying to update bots...")
-        run_bots()
-    except Exception as e:
-        logging.error(f"PYTHON ERROR: {e}")
-    
-    logging.info(f"Bots updated.")
 
+@app.route('/ohlcv')
+def ohlcv():
+    return query_route("ohlcv_response")
 
 
-    try:
-        logging.info(f"Trying ping telegram...")
-        ping_telegram()
-    except Exception as e:
-        logging.error(f"PYTHON ERROR: {e}")
-    
-    logging.info(f"Telegram pinged.")
+@app.route('/positions')
+def positions():
+    return query_route("positions_response")
+
 
+@app.route('/metrics')
+def metrics_route():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
-    logging.info(f"Task finished.")
+def main():
+    runner.trigger(profile=profile_runs)
+    runner.wait()
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=8080)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=8080)
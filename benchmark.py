@@ -0,0 +1,506 @@
+
+import os
+import gc
+import json
+import time
+import zlib
+import argparse
+import logging
+import datetime
+import threading
+import importlib
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+
+from binance_rest import KlineClient
+from bots_config import validate_bots
+from hourly_resample import resample_hourly
+from strategies import ZURFER_CONDITIONS, run_strategy, get_zurfer_bots_data, get_zzurfer_bots_data, get_random_bots_data
+from zlema_engine import ZlemaEngine
+from indicator_cache import IndicatorCache
+
+
+MINUTE_MS = 60_000
+
+DEFAULT_BASELINE = "benchmark_baseline.json"
+
+# Relative change of a metric that counts as a regression
+DEFAULT_TOLERANCE = 0.25
+# RSS moves by a few MB between identical runs, smaller changes are never flagged
+RSS_SLACK_MB = 32
+
+# Tables benchmark.py empties in the bench database before each run
+BENCH_TABLES = ("market_data", "market_data_1h", "market_data_1d", "ingest_watermarks", "bots", "indicator_state")
+
+
+def synthetic_klines(symbol, start_ms, minutes):
+    """
+    Deterministic 1m OHLCV of `symbol` from `start_ms` on, as int64 open
+    times plus float64 open/high/low/close/volume arrays. A geometric
+    random walk seeded by the symbol name, so every run (and the fake
+    server) sees the same candles.
+    """
+    rng = np.random.default_rng(zlib.crc32(symbol.encode()))
+    returns = rng.normal(0.0, 0.0008, minutes)
+    close = 100.0 * np.exp(np.cumsum(returns))
+    open_ = np.empty(minutes)
+    open_[0] = 100.0
+    open_[1:] = close[:-1]
+    spread = np.abs(rng.normal(0.0, 0.0004, minutes)) * close
+    return {
+        "timestamp": start_ms + np.arange(minutes, dtype=np.int64) * MINUTE_MS,
+        "open": open_,
+        "high": np.maximum(open_, close) + spread,
+        "low": np.minimum(open_, close) - spread,
+        "close": close,
+        "volume": rng.lognormal(3.0, 1.0, minutes),
+    }
+
+
+def klines_to_frame(klines):
+    """
+    The market_data layout of synthetic_klines output, as update_database
+    writes it.
+    """
+    index = pd.DatetimeIndex(klines["timestamp"] * 1_000_000, name="timestamp").tz_localize("UTC")
+    return pd.DataFrame({column: klines[column] for column in ("open", "high", "low", "close", "volume")}, index=index)
+
+
+def synthetic_bots(symbols, bots_per_symbol, seed=0):
+    """
+    A valid bots_config.json list with zurfer, zzurfer and random bots
+    spread over `symbols`.
+    """
+    rng = np.random.default_rng(seed)
+    conditions = sorted(ZURFER_CONDITIONS)
+    bots = []
+    for symbol in symbols:
+        for i in range(bots_per_symbol):
+            strategy = ("zurfer", "zzurfer", "random")[i % 3]
+            bot = {"bot_name": f"bench_{symbol}_{strategy}_{i}", "strategy": strategy, "symbol": symbol}
+            if strategy == "random":
+                bot["seed"] = int(rng.integers(1_000_000))
+            else:
+                bot["first_zlema_period"] = int(rng.integers(5, 100))
+                bot["second_zlema_period"] = int(rng.integers(10, 300))
+                bot["condition"] = int(rng.choice(conditions))
+            if strategy == "zzurfer":
+                bot["first_zlema_period_2"] = int(rng.integers(5, 100))
+                bot["second_zlema_period_2"] = int(rng.integers(10, 300))
+                bot["condition_2"] = int(rng.choice(conditions))
+            bots.append(bot)
+    return validate_bots(bots)
+
+
+class FakeKlineServer:
+    """
+    Local stand-in for Binance's /api/v3/klines serving synthetic_klines,
+    for KlineClient(api_url=server.url). Responds as fast as it can, with
+    no rate limits.
+    """
+
+    def __init__(self, start_ms, minutes, host="127.0.0.1", port=0):
+        self.start_ms = start_ms
+        self.minutes = minutes
+        self.klines = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != "/api/v3/klines":
+                    return self._send(404, {"code": -1, "msg": "Not found"})
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                try:
+                    rows = server.rows(params)
+                except KeyError:
+                    return self._send(400, {"code": -1121, "msg": "Invalid symbol."})
+                self._send(200, rows)
+
+            def _send(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/api"
+
+    def add_symbol(self, symbol):
+        with self.lock:
+            if symbol not in self.klines:
+                self.klines[symbol] = synthetic_klines(symbol, self.start_ms, self.minutes)
+            return self.klines[symbol]
+
+    def rows(self, params):
+        with self.lock:
+            self.requests += 1
+            klines = self.klines[params["symbol"]]
+
+        limit = min(int(params.get("limit", 500)), 1000)
+        start = max(0, -(-(int(params.get("startTime", 0)) - self.start_ms) // MINUTE_MS))
+        end = self.minutes - 1
+        if "endTime" in params:
+            end = min(end, (int(params["endTime"]) - self.start_ms) // MINUTE_MS)
+        end = min(end, start + limit - 1)
+        if end < start:
+            return []
+
+        window = slice(start, end + 1)
+        open_times = klines["timestamp"][window].tolist()
+        columns = [klines[column][window].tolist() for column in ("open", "high", "low", "close", "volume")]
+        return [
+            [open_time, str(o), str(h), str(l), str(c), str(v), open_time + MINUTE_MS - 1, "0", 0, "0", "0", "0"]
+            for open_time, o, h, l, c, v in zip(open_times, *columns)
+        ]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="fake-kline-server", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class RssSampler:
+    """
+    Peak resident set size of this process while a stage runs, sampled
+    from /proc/self/statm on a background thread. Where /proc isn't
+    available the process-lifetime peak from getrusage is used instead.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self.peak = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def current(self):
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * self.page_size
+        except OSError:
+            import resource
+            # KiB on Linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _sample(self):
+        while not self.stopping.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+    def start(self):
+        self.peak = self.current()
+        self.thread = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        return max(self.peak, self.current())
+
+
+class StageRun:
+    """
+    Units of work of one stage: latency of each unit and the rows it
+    processed.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.rows = 0
+
+    @contextmanager
+    def unit(self):
+        sample = {"rows": 0}
+        began = time.perf_counter()
+        yield sample
+        self.latencies.append(time.perf_counter() - began)
+        self.rows += sample["rows"]
+
+
+def run_stage(name, stage, context):
+    gc.collect()
+    run = StageRun()
+    sampler = RssSampler().start()
+    began = time.perf_counter()
+    stage(context, run)
+    wall = time.perf_counter() - began
+    peak = sampler.stop()
+
+    latencies = np.asarray(run.latencies or [wall]) * 1000
+    result = {
+        "rows": run.rows,
+        "units": len(run.latencies),
+        "seconds": round(wall, 4),
+        "rows_per_s": round(run.rows / wall, 1) if wall > 0 else None,
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        "peak_rss_mb": round(peak / 2 ** 20, 1),
+    }
+    logging.info(f"{name}: {result}")
+    return result
+
+
+def stage_fetch(context, run):
+    # KlineClient against the fake server, a month of 1m candles per unit. The
+    # server runs in this process, so its JSON encoding is part of the figure
+    client = KlineClient(context["server"].url)
+    month = pd.Timedelta(days=30)
+    for symbol in context["symbols"]:
+        start = context["start"]
+        while start < context["end"]:
+            end = min(start + month, context["end"])
+            with run.unit() as sample:
+                sample["rows"] = len(client.download(symbol, start, end - pd.Timedelta(minutes=1)))
+            start = end
+
+
+def stage_resample_1h(context, run):
+    for symbol in context["symbols"]:
+        minutes = klines_to_frame(context["server"].add_symbol(symbol))
+        with run.unit() as sample:
+            resample_hourly(minutes[["open", "close"]])
+            sample["rows"] = len(minutes)
+        del minutes
+
+
+def _strategy_stage(function, strategy):
+    def stage(context, run):
+        # One engine per run, as in run_bots, with every ZLEMA computed from scratch
+        zlema_engine = ZlemaEngine(cache=IndicatorCache())
+        for bot in context["bots"]:
+            if bot["strategy"] != strategy:
+                continue
+            hourly = context["hourly"][bot["symbol"]]
+            with run.unit() as sample:
+                function({**bot, "most_recent_timestamp": None}, hourly, zlema_engine)
+                sample["rows"] = len(hourly)
+    return stage
+
+
+def stage_update_database(context, run):
+    from update_database import update_database
+
+    with run.unit() as sample:
+        timings = update_database()
+        sample["rows"] = sum(timing["rows_written"] for timing in timings.values())
+
+
+def stage_load_symbol_data(context, run):
+    from pg_binary import read_prices
+
+    # What run_bots' load_symbol_data reads for a cold symbol
+    with context["engine"].connect() as connection:
+        for symbol in context["symbols"]:
+            with run.unit() as sample:
+                columns = read_prices(connection, "market_data_1h", symbol, context["start"], context["end"])
+                sample["rows"] = len(columns["timestamp"])
+
+
+def stage_bots_write(context, run):
+    from bulk_write import copy_frame
+
+    zlema_engine = ZlemaEngine(cache=IndicatorCache())
+    for bot in context["bots"]:
+        bot_data = run_strategy({**bot, "most_recent_timestamp": None}, context["hourly"][bot["symbol"]], zlema_engine)
+        with run.unit() as sample:
+            with context["engine"].begin() as connection:
+                sample["rows"] = copy_frame(connection, bot_data, "bots", index=False)
+
+
+# (name, needs the bench database, stage), in run order
+STAGES = [
+    ("fetch", False, stage_fetch),
+    ("update_database", True, stage_update_database),
+    ("load_symbol_data", True, stage_load_symbol_data),
+    ("resample_1h", False, stage_resample_1h),
+    ("get_zurfer_bots_data", False, _strategy_stage(get_zurfer_bots_data, "zurfer")),
+    ("get_zzurfer_bots_data", False, _strategy_stage(get_zzurfer_bots_data, "zzurfer")),
+    ("get_random_bots_data", False, _strategy_stage(get_random_bots_data, "random")),
+    ("bots_write", True, stage_bots_write),
+]
+
+
+def prepare_database(database_url, context):
+    """
+    Point db.get_engine at the bench database, create the schema and
+    empty it, then write each symbol's first candle so update_database
+    picks the symbols up and downloads the rest from the fake server.
+    """
+    from sqlalchemy import text
+    from sqlalchemy.engine import make_url
+
+    if "bench" not in (make_url(database_url).database or ""):
+        raise SystemExit(f"Refusing to empty {make_url(database_url).database!r}, the database name must contain 'bench'")
+
+    os.environ["databaseurl"] = database_url
+    os.environ["binanceapiurl"] = context["server"].url
+    os.environ["binanceweightperminute"] = str(10 ** 9)
+
+    from db import get_engine
+    engine = get_engine()
+    # Creates every table on the shared engine
+    importlib.import_module("create_market_data")
+
+    from update_database import write_klines
+    from ingest_state import ensure_watermarks
+    from market_data_rollup import ensure_rollups
+
+    with engine.begin() as connection:
+        ensure_watermarks(connection)
+        ensure_rollups(connection)
+        connection.execute(text(f"TRUNCATE {', '.join(BENCH_TABLES)}"))
+
+    for symbol in context["symbols"]:
+        first = klines_to_frame(context["server"].add_symbol(symbol)).iloc[:1].copy()
+        first["symbol"] = symbol
+        write_klines(engine, first)
+
+    return engine
+
+
+def compare(results, baseline, tolerance):
+    """
+    Regressions of `results` against `baseline`, as human readable lines.
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get("stages", {}).get(name)
+        if before is None:
+            continue
+
+        if before["rows_per_s"] and result["rows_per_s"] is not None:
+            if result["rows_per_s"] < before["rows_per_s"] * (1 - tolerance):
+                regressions.append(f"{name}: throughput {before['rows_per_s']:.0f} -> {result['rows_per_s']:.0f} rows/s")
+
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']:.1f} -> {result['p95_ms']:.1f} ms")
+
+        if result["peak_rss_mb"] > max(before["peak_rss_mb"] * (1 + tolerance), before["peak_rss_mb"] + RSS_SLACK_MB):
+            regressions.append(f"{name}: peak RSS {before['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+def print_report(results, baseline):
+    stages = baseline.get("stages", {}) if baseline else {}
+    print(f"{'stage':<24}{'rows/s':>14}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}{'peak RSS MB':>13}{'vs baseline':>14}")
+    for name, result in results.items():
+        change = ""
+        before = stages.get(name)
+        if before and before["rows_per_s"] and result["rows_per_s"]:
+            change = f"{result['rows_per_s'] / before['rows_per_s'] - 1:+.1%}"
+        print(
+            f"{name:<24}{result['rows_per_s'] or 0:>14,.0f}{result['p50_ms']:>11.1f}{result['p95_ms']:>11.1f}"
+            f"{result['p99_ms']:>11.1f}{result['peak_rss_mb']:>13.0f}{change:>14}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data")
+
+    parser.add_argument('-symbols', required=False, type=int, default=4, help='Synthetic symbols')
+    parser.add_argument('-years', required=False, type=float, default=2, help='Years of 1m history per symbol')
+    parser.add_argument('-botspersymbol', required=False, type=int, default=6, help='Synthetic bots per symbol')
+    parser.add_argument('-database', required=False, default=None,
+                        help="URL of a throwaway PostgreSQL database (its name must contain 'bench'), database stages are skipped without it")
+    parser.add_argument('-stages', required=False, default=None, help='Comma separated stages to run (default all)')
+    parser.add_argument('-baseline', required=False, default=DEFAULT_BASELINE, help='Baseline JSON to compare against')
+    parser.add_argument('-savebaseline', action='store_true', help='Save these results as the baseline')
+    parser.add_argument('-tolerance', required=False, type=float, default=DEFAULT_TOLERANCE, help='Relative change flagged as a regression')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    end = pd.Timestamp.now(tz="UTC").floor("min")
+    start = end - pd.Timedelta(days=round(365 * args.years))
+    minutes = int((end - start) / pd.Timedelta(minutes=1))
+
+    symbols = [f"BENCH{i}USDT" for i in range(args.symbols)]
+    server = FakeKlineServer(start.value // 1_000_000, minutes).start()
+    for symbol in symbols:
+        server.add_symbol(symbol)
+
+    context = {
+        "symbols": symbols,
+        "start": start,
+        "end": end,
+        "server": server,
+        "bots": synthetic_bots(symbols, args.botspersymbol),
+        "hourly": {
+            symbol: resample_hourly(klines_to_frame(server.add_symbol(symbol))[["open", "close"]])
+            for symbol in symbols
+        },
+    }
+
+    selected = set(args.stages.split(",")) if args.stages else None
+    stages = [(name, needs_db, stage) for name, needs_db, stage in STAGES if selected is None or name in selected]
+    if args.database:
+        context["engine"] = prepare_database(args.database, context)
+    else:
+        skipped = [name for name, needs_db, _ in stages if needs_db]
+        if skipped:
+            logging.info(f"No -database, skipping {', '.join(skipped)}")
+        stages = [(name, needs_db, stage) for name, needs_db, stage in stages if not needs_db]
+
+    results = {}
+    try:
+        for name, _, stage in stages:
+            results[name] = run_stage(name, stage, context)
+    finally:
+        server.stop()
+
+    config = {"symbols": args.symbols, "years": args.years, "bots_per_symbol": args.botspersymbol}
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            logging.warning(f"Baseline was recorded with {baseline.get('config')}, not {config}")
+
+    print_report(results, baseline)
+
+    regressions = compare(results, baseline, args.tolerance) if baseline else []
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+
+    if args.savebaseline:
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "recorded_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "config": config,
+                "stages": results,
+            }, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,143 @@
+
+import time
+import random
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+import requests
+
+import metrics
+
+DEFAULT_API_URL = "https://api.binance.com/api"
+
+KLINES_REQUEST_WEIGHT = 2
+KLINES_PAGE_LIMIT = 1000
+
+KLINE_COLUMNS = ["Open", "High", "Low", "Close", "Volume"]
+
+# Rate limited (429) or IP banned for ignoring rate limits (418)
+RATE_LIMIT_STATUSES = (418, 429)
+
+
+class KlineClient:
+    """
+    Minimal client for Binance's public /v3/klines endpoint, in place of
+    vectorbt's BinanceData and python-binance. Pages through a range
+    1000 candles per request and retries throttled (honouring
+    Retry-After), failed and unreachable requests with backoff. Safe to
+    share between threads, each thread gets its own HTTP session.
+
+    `api_url` can point at a local stand-in serving the same routes, e.g.
+    http://127.0.0.1:8000/api.
+    """
+
+    def __init__(self, api_url=None, timeout=10, attempts=5, base_delay=1.0, max_delay=60.0):
+        self.api_url = (api_url or DEFAULT_API_URL).rstrip("/")
+        self.timeout = timeout
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _get(self, path, params, budget=None, weight=1):
+        url = f"{self.api_url}/{path}"
+        for attempt in range(1, self.attempts + 1):
+            if budget is not None:
+                budget.acquire(weight)
+
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * (0.5 + random.random())
+            began = time.perf_counter()
+            try:
+                response = self._session().get(url, params=params, timeout=self.timeout)
+            except requests.RequestException as e:
+                metrics.binance_request_seconds.observe(time.perf_counter() - began, path=path, outcome="error")
+                error = e
+                reason = "error"
+            else:
+                outcome = "ok" if response.ok else str(response.status_code)
+                metrics.binance_request_seconds.observe(time.perf_counter() - began, path=path, outcome=outcome)
+                if response.ok:
+                    return response.json()
+                if response.status_code in RATE_LIMIT_STATUSES:
+                    delay = max(delay, float(response.headers.get("Retry-After", 0)))
+                    reason = "throttled"
+                elif response.status_code < 500:
+                    # Bad symbol or parameters, retrying won't help
+                    response.raise_for_status()
+                else:
+                    reason = "server_error"
+                error = f"HTTP {response.status_code}: {response.text[:200]}"
+
+            if attempt == self.attempts:
+                raise RuntimeError(f"GET {path} {params} failed after {attempt} attempts: {error}")
+            logging.warning(f"GET {path} failed (attempt {attempt}/{self.attempts}): {error}. Retrying in {delay:.1f}s")
+            metrics.binance_request_retries.inc(path=path, reason=reason)
+            time.sleep(delay)
+
+    def klines_page(self, symbol, interval, start_ms, end_ms, limit=KLINES_PAGE_LIMIT, budget=None):
+        """
+        Raw rows of one /v3/klines request, open times in [start_ms, end_ms].
+        """
+        params = {"symbol": symbol, "interval": interval, "startTime": int(start_ms), "endTime": int(end_ms), "limit": limit}
+        return self._get("v3/klines", params, budget, KLINES_REQUEST_WEIGHT)
+
+    def download(self, symbol, start, end, interval="1m", budget=None, limit=KLINES_PAGE_LIMIT):
+        """
+        Candles of `symbol` opening in [start, end], oldest first, as a
+        DataFrame of float64 Open/High/Low/Close/Volume columns on a UTC
+        DatetimeIndex of open times.
+        """
+        start_ms = _epoch_ms(start)
+        end_ms = _epoch_ms(end)
+
+        pages = []
+        while start_ms <= end_ms:
+            rows = self.klines_page(symbol, interval, start_ms, end_ms, limit, budget)
+            if not rows:
+                break
+            pages.append(rows)
+            if len(rows) < limit:
+                break
+            start_ms = rows[-1][0] + 1
+
+        return klines_frame([row for rows in pages for row in rows])
+
+    def listing_timestamp(self, symbol, interval="1m", budget=None):
+        """
+        Open time of the first `interval` candle Binance has for `symbol`.
+        """
+        rows = self._get("v3/klines", {"symbol": symbol, "interval": interval, "startTime": 0, "limit": 1},
+                         budget, KLINES_REQUEST_WEIGHT)
+        if not rows:
+            raise ValueError(f"No klines for {symbol}")
+        return pd.Timestamp(rows[0][0], unit="ms", tz="UTC")
+
+
+def klines_frame(rows):
+    if not rows:
+        index = pd.DatetimeIndex([], tz="UTC", name="Open time")
+        return pd.DataFrame({column: np.empty(0, dtype=np.float64) for column in KLINE_COLUMNS}, index=index)
+
+    data = np.asarray([row[:6] for row in rows], dtype=object)
+    index = pd.DatetimeIndex(data[:, 0].astype(np.int64) * 1_000_000, name="Open time").tz_localize("UTC")
+    frame = pd.DataFrame(
+        {column: data[:, i + 1].astype(np.float64) for i, column in enumerate(KLINE_COLUMNS)},
+        index=index,
+    )
+    # Consecutive pages can repeat a boundary candle
+    return frame[~frame.index.duplicated()]
+
+
+def _epoch_ms(timestamp):
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize("UTC")
+    return timestamp.value // 1_000_000
@@ -0,0 +1,114 @@
+
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pandas as pd
+
+from hourly_resample import epoch_ns
+from indicator_cache import IndicatorCache
+from strategies import run_strategy
+from zlema_engine import ZlemaEngine
+
+
+HOURLY_COLUMNS = ["timestamp", "open", "close"]
+
+
+def share_hourly(hourly):
+    """
+    Copy an hourly frame's timestamp/open/close into one shared memory
+    block. Returns the block (the caller unlinks it) and a small picklable
+    spec for the workers.
+    """
+    rows = len(hourly)
+    shared = SharedMemory(create=True, size=max(1, rows * 8 * len(HOURLY_COLUMNS)))
+    layout = np.ndarray((len(HOURLY_COLUMNS), rows), dtype=np.int64, buffer=shared.buf)
+    layout[0] = epoch_ns(hourly.index)
+    layout[1] = hourly["open"].to_numpy(dtype=np.float64).view(np.int64)
+    layout[2] = hourly["close"].to_numpy(dtype=np.float64).view(np.int64)
+    del layout
+    return shared, {"name": shared.name, "rows": rows}
+
+
+def attach_hourly(spec):
+    try:
+        shared = SharedMemory(name=spec["name"], track=False)
+    except TypeError:
+        # Before Python 3.13 the block is registered again with the resource
+        # tracker the pool shares with the parent, which unlinks it once
+        shared = SharedMemory(name=spec["name"])
+
+    try:
+        layout = np.ndarray((len(HOURLY_COLUMNS), spec["rows"]), dtype=np.int64, buffer=shared.buf)
+        index = pd.DatetimeIndex(layout[0].copy().view("datetime64[ns]")).tz_localize("UTC")
+        hourly = pd.DataFrame(
+            {"open": layout[1].view(np.float64).copy(), "close": layout[2].view(np.float64).copy()},
+            index=index,
+        )
+        del layout
+    finally:
+        shared.close()
+
+    return hourly
+
+
+def evaluate_symbol(bots, hourly, zlema_engine, verify=False):
+    """
+    Run every (index, bot) of one symbol in order. Returns a list of
+    (index, bot_data) pairs.
+    """
+    return [(i, run_strategy(bot, hourly, zlema_engine, verify)) for i, bot in bots]
+
+
+def _evaluate_group(spec, bots, states, watermarks, verify, cache_bytes):
+    hourly = attach_hourly(spec)
+    cache = IndicatorCache(cache_bytes)
+    zlema_engine = ZlemaEngine(states, cache, watermarks)
+
+    results = evaluate_symbol(bots, hourly, zlema_engine, verify)
+
+    updated = {key: zlema_engine.states[key] for key in zlema_engine.dirty}
+    return results, updated, (cache.hits, cache.misses, cache.evictions)
+
+
+def evaluate_parallel(groups, zlema_engine, verify=False, workers=2):
+    """
+    Evaluate bots grouped by symbol on a process pool. `groups` yields
+    (symbol, (bots, hourly)) pairs, with bots as (index, bot) pairs, and
+    is consumed as symbols are submitted. Each symbol's hourly arrays go
+    through shared memory instead of being pickled, and the ZLEMA states
+    the workers advance are merged back into `zlema_engine`. Results come
+    back in bot index order, exactly as the serial path would produce
+    them.
+    """
+    shared_blocks = []
+    results = []
+    try:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = []
+            for symbol, (bots, hourly) in groups:
+                shared, spec = share_hourly(hourly)
+                shared_blocks.append(shared)
+                states = {key: state for key, state in zlema_engine.states.items() if key[0] == symbol}
+                watermarks = {symbol: zlema_engine.watermarks[symbol]} if symbol in zlema_engine.watermarks else {}
+                futures.append(executor.submit(
+                    _evaluate_group, spec, bots, states, watermarks, verify, zlema_engine.cache.max_bytes))
+
+            for future in futures:
+                group_results, updated, (hits, misses, evictions) = future.result()
+                results.extend(group_results)
+                zlema_engine.states.update(updated)
+                zlema_engine.dirty.update(updated)
+                zlema_engine.cache.hits += hits
+                zlema_engine.cache.misses += misses
+                zlema_engine.cache.evictions += evictions
+    finally:
+        for shared in shared_blocks:
+            shared.close()
+            shared.unlink()
+
+    results.sort(key=lambda result: result[0])
+    return results
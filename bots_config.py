@@ -0,0 +1,172 @@
+
+import os
+import json
+import logging
+
+import requests
+
+from strategies import ZURFER_CONDITIONS
+
+
+DEFAULT_URL = "https://api.github.com/repos/mendoncaDS/zlema_bots_config/contents/bots_config.json?ref=main"
+
+COMMON_FIELDS = ("bot_name", "strategy", "symbol")
+
+STRATEGY_FIELDS = {
+    "zurfer": ("first_zlema_period", "second_zlema_period", "condition"),
+    "zzurfer": (
+        "first_zlema_period", "second_zlema_period", "condition",
+        "first_zlema_period_2", "second_zlema_period_2", "condition_2",
+    ),
+    "random": ("seed",),
+}
+
+
+class BotsConfigError(Exception):
+    pass
+
+
+def validate_bots(bots):
+    """
+    Check the parsed bots_config.json: a list of bot objects with the
+    fields their strategy needs, known zurfer conditions and unique names.
+    """
+    if not isinstance(bots, list):
+        raise BotsConfigError("bots_config.json must contain a list of bots")
+
+    names = set()
+    for i, bot in enumerate(bots):
+        if not isinstance(bot, dict):
+            raise BotsConfigError(f"Bot #{i} is not an object")
+
+        missing = [field for field in COMMON_FIELDS if field not in bot]
+        if missing:
+            raise BotsConfigError(f"Bot #{i} is missing {', '.join(missing)}")
+
+        strategy = bot["strategy"]
+        if strategy not in STRATEGY_FIELDS:
+            raise BotsConfigError(f"Bot {bot['bot_name']} has an unknown strategy {strategy!r}")
+
+        missing = [field for field in STRATEGY_FIELDS[strategy] if field not in bot]
+        if missing:
+            raise BotsConfigError(f"Bot {bot['bot_name']} is missing {', '.join(missing)}")
+
+        for field in ("condition", "condition_2"):
+            if field in STRATEGY_FIELDS[strategy] and bot[field] not in ZURFER_CONDITIONS:
+                raise BotsConfigError(f"Bot {bot['bot_name']} has an unknown {field} {bot[field]!r}")
+
+        if bot["bot_name"] in names:
+            raise BotsConfigError(f"Bot name {bot['bot_name']} is used more than once")
+        names.add(bot["bot_name"])
+
+    return bots
+
+
+class BotsConfigLoader:
+    """
+    Fetches bots_config.json with If-None-Match against the ETag of the
+    copy cached on disk, so an unchanged config costs a 304. Network and
+    HTTP errors, and fetched configs that fail to parse or validate, fall
+    back to the cached copy. The parsed, validated bot
+    list is kept for the lifetime of the process and only parsed again
+    when the server sends a new version.
+    """
+
+    def __init__(self, url=DEFAULT_URL, token=None, cache_path="bots_config_cache/bots_config.json", timeout=10, session=None):
+        self.url = url
+        self.token = token
+        self.cache_path = cache_path
+        self.etag_path = cache_path + ".etag"
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.bots = None
+        self.etag = None
+
+    def _headers(self, etag):
+        headers = {"Accept": "application/vnd.github.v3.raw"}
+        if self.token:
+            headers["Authorization"] = f"token {self.token}"
+        if etag:
+            headers["If-None-Match"] = etag
+        return headers
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_path, "rb") as f:
+                body = f.read()
+        except FileNotFoundError:
+            return None, None
+        try:
+            with open(self.etag_path) as f:
+                etag = f.read().strip() or None
+        except FileNotFoundError:
+            etag = None
+        return body, etag
+
+    def _write_cache(self, body, etag):
+        directory = os.path.dirname(self.cache_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        for path, data in ((self.cache_path, body), (self.etag_path, (etag or "").encode())):
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+
+    def _use(self, body, etag):
+        bots = validate_bots(json.loads(body))
+        self.bots, self.etag = bots, etag
+        return bots
+
+    def load(self):
+        """
+        The current bot list. Raises BotsConfigError when the config can
+        neither be fetched nor read from the cache.
+        """
+        if self.bots is not None:
+            body, etag = None, self.etag
+        else:
+            body, etag = self._read_cache()
+
+        try:
+            response = self.session.get(self.url, headers=self._headers(etag), timeout=self.timeout)
+        except requests.RequestException as e:
+            logging.warning(f"Could not fetch bots config ({e}), using the cached copy.")
+            response = None
+
+        if response is not None and response.status_code == 304:
+            logging.info("Bots config unchanged.")
+        elif response is not None and response.ok:
+            new_etag = response.headers.get("ETag")
+            try:
+                bots = self._use(response.content, new_etag)
+            except (BotsConfigError, ValueError) as e:
+                # A broken push must not stop the bots, keep running the last good config
+                logging.error(f"Fetched bots config is invalid ({e}), using the cached copy.")
+            else:
+                self._write_cache(response.content, new_etag)
+                logging.info(f"Fetched bots config with {len(bots)} bots.")
+                return bots
+        elif response is not None:
+            logging.warning(f"Could not fetch bots config: {response.status_code}, using the cached copy.")
+
+        if self.bots is not None:
+            return self.bots
+        if body is None:
+            raise BotsConfigError("Bots config is unavailable and there is no cached copy")
+        return self._use(body, etag)
+
+
+_loaders = {}
+
+
+def load_bots_config(url=DEFAULT_URL, token=None, cache_path="bots_config_cache/bots_config.json", session=None):
+    """
+    Bot list from one loader per (url, cache_path) shared by the whole
+    process, so repeated runs only revalidate.
+    """
+    key = (url, cache_path)
+    if key not in _loaders:
+        _loaders[key] = BotsConfigLoader(url, token, cache_path, session=session)
+    return _loaders[key].load()
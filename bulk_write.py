@@ -0,0 +1,82 @@
+
+import io
+import time
+import logging
+
+import pandas as pd
+
+import metrics
+
+
+# Rows per COPY round trip, keeps the CSV buffer small on large backfills
+COPY_CHUNK_ROWS = 100_000
+
+
+def _prepare_frame(frame, index):
+    data = frame.reset_index() if index else frame.copy()
+
+    # Timestamps are stored as naive UTC, same as the existing rows
+    for column in data.columns:
+        if isinstance(data[column].dtype, pd.DatetimeTZDtype):
+            data[column] = data[column].dt.tz_convert("UTC").dt.tz_localize(None)
+
+    return data
+
+
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def copy_frame(connection, frame, table, index=True, chunk_rows=COPY_CHUNK_ROWS):
+    """
+    Insert a DataFrame into `table` with COPY FROM STDIN, skipping rows
+    whose primary key already exists.
+
+    Rows are streamed into a temporary staging table shaped like `table`
+    and then merged with INSERT ... ON CONFLICT DO NOTHING, so overlapping
+    or retried runs don't abort on duplicate keys.
+
+    `connection` is a SQLAlchemy connection inside a transaction
+    (e.g. from engine.begin()). Returns the number of rows inserted.
+    """
+    if frame is None or frame.empty:
+        return 0
+
+    began = time.perf_counter()
+    data = _prepare_frame(frame, index)
+
+    columns = ", ".join(_quote(column) for column in data.columns)
+    staging = _quote(f"{table}_staging")
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+        cursor.execute(
+            f"CREATE TEMP TABLE {staging} "
+            f"(LIKE {_quote(table)} INCLUDING DEFAULTS) ON COMMIT DROP"
+        )
+
+        for start in range(0, len(data), chunk_rows):
+            buffer = io.StringIO()
+            data.iloc[start:start + chunk_rows].to_csv(buffer, header=False, index=False)
+            buffer.seek(0)
+            cursor.copy_expert(
+                f"COPY {staging} ({columns}) FROM STDIN WITH (FORMAT csv)",
+                buffer,
+            )
+
+        cursor.execute(
+            f"INSERT INTO {_quote(table)} ({columns}) "
+            f"SELECT {columns} FROM {staging} "
+            f"ON CONFLICT DO NOTHING"
+        )
+        inserted = cursor.rowcount
+        cursor.execute(f"DROP TABLE {staging}")
+    finally:
+        cursor.close()
+
+    metrics.db_copy_seconds.observe(time.perf_counter() - began, table=table, direction="in")
+    metrics.db_copy_rows.inc(inserted, table=table, direction="in")
+    logging.info(f"Copied {len(data)} rows into {table}, {inserted} new.")
+
+    return inserted
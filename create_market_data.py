@@ -1,31 +1,59 @@
-import os
+import datetime
 
-from dotenv import load_dotenv
 from sqlalchemy.ext.declarative import declarative_base
 
-from sqlalchemy import create_engine, Column, String, Float, Boolean, DateTime, PrimaryKeyConstraint
+from db import get_engine
+from market_data_schema import SCHEMA_VERSION, PARTITIONS_FROM, ensure_partitions, get_schema_version, set_schema_version, is_partitioned
+from sqlalchemy import text, Column, String, Float, Integer, BigInteger, Boolean, DateTime, ARRAY, Index, PrimaryKeyConstraint
 
-load_dotenv()
-database_password = os.environ.get('password')
-server_address = os.environ.get('serverip')
-
-connection_string = f"postgresql://postgres:{database_password}@{server_address}:5432/postgres"
-engine = create_engine(connection_string, echo=True)
+engine = get_engine(echo=True)
 
 Base = declarative_base()
 
 class MarketData(Base):
+    # Schema version 2, existing version 1 tables are upgraded with migrate_market_data.py
     __tablename__ = 'market_data'
     timestamp = Column(DateTime, nullable=False)
+    open = Column(Float)
+    high = Column(Float)
+    low = Column(Float)
+    close = Column(Float)
+    volume = Column(Float)
+    symbol = Column(String, nullable=False)
+    interval = Column(String, nullable=False, server_default=text("'1m'"))
+
+    __table_args__ = (
+        PrimaryKeyConstraint('symbol', 'interval', 'timestamp'),
+        Index('market_data_timestamp_brin', 'timestamp', postgresql_using='brin'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
+
+class MarketData1h(Base):
+    __tablename__ = 'market_data_1h'
+    timestamp = Column(DateTime, nullable=False)
     symbol = Column(String, nullable=False)
     open = Column(Float)
     high = Column(Float)
     low = Column(Float)
     close = Column(Float)
     volume = Column(Float)
-    
+
     __table_args__ = (
-        PrimaryKeyConstraint('timestamp', 'symbol'),
+        PrimaryKeyConstraint('symbol', 'timestamp'),
+    )
+
+class MarketData1d(Base):
+    __tablename__ = 'market_data_1d'
+    timestamp = Column(DateTime, nullable=False)
+    symbol = Column(String, nullable=False)
+    open = Column(Float)
+    high = Column(Float)
+    low = Column(Float)
+    close = Column(Float)
+    volume = Column(Float)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('symbol', 'timestamp'),
     )
 
 class Bots(Base):
@@ -37,7 +65,73 @@ class Bots(Base):
 
     __table_args__ = (
         PrimaryKeyConstraint('timestamp', 'bot_name', 'symbol'),
+        # Backs the per-bot MAX(timestamp) lookups of run_bots
+        Index('ix_bots_bot_name_timestamp', 'bot_name', 'timestamp'),
+    )
+
+class AnnouncedTransitions(Base):
+    __tablename__ = 'announced_transitions'
+    bot_name = Column(String, nullable=False)
+    timestamp = Column(DateTime, nullable=False)
+    position = Column(Boolean, nullable=False)
+    announced_at = Column(DateTime, nullable=False, server_default=text("(now() AT TIME ZONE 'utc')"))
+
+    __table_args__ = (
+        PrimaryKeyConstraint('bot_name', 'timestamp'),
+    )
+
+class IngestWatermarks(Base):
+    __tablename__ = 'ingest_watermarks'
+    symbol = Column(String, nullable=False)
+    interval = Column(String, nullable=False)
+    last_timestamp = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False, server_default=text("(now() AT TIME ZONE 'utc')"))
+
+    __table_args__ = (
+        PrimaryKeyConstraint('symbol', 'interval'),
+    )
+
+class BootstrapShards(Base):
+    __tablename__ = 'bootstrap_shards'
+    symbol = Column(String, nullable=False)
+    interval = Column(String, nullable=False)
+    shard_start = Column(DateTime, nullable=False)
+    shard_end = Column(DateTime, nullable=False)
+    position = Column(DateTime, nullable=False)
+    completed = Column(Boolean, nullable=False, server_default=text("FALSE"))
+
+    __table_args__ = (
+        PrimaryKeyConstraint('symbol', 'interval', 'shard_start'),
+    )
+
+class IndicatorState(Base):
+    __tablename__ = 'indicator_state'
+    symbol = Column(String, nullable=False)
+    indicator = Column(String, nullable=False)
+    interval = Column(String, nullable=False)
+    period = Column(Integer, nullable=False)
+    timestamp = Column(DateTime, nullable=False)
+    value = Column(Float)
+    bars = Column(BigInteger, nullable=False)
+    seed_sum = Column(Float, nullable=False)
+    seed_count = Column(Integer, nullable=False)
+    lagged = Column(ARRAY(Float), nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('symbol', 'indicator', 'interval', 'period'),
     )
 
 # Create the tables
 Base.metadata.create_all(engine)
+
+# create_all skips tables that already exist, so add newer indexes to them too
+for index in Bots.__table__.indexes:
+    index.create(engine, checkfirst=True)
+
+with engine.begin() as connection:
+    if is_partitioned(connection):
+        ensure_partitions(connection, PARTITIONS_FROM, datetime.datetime.utcnow())
+        if get_schema_version(connection) < SCHEMA_VERSION:
+            set_schema_version(connection, SCHEMA_VERSION)
+    else:
+        print("market_data is an unpartitioned version 1 table, run migrate_market_data.py to upgrade it")
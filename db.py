@@ -0,0 +1,64 @@
+
+import os
+import time
+import threading
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, event
+
+import metrics
+
+
+_engine = None
+_lock = threading.Lock()
+
+
+def connection_string():
+    load_dotenv()
+    # Full URL override, e.g. a throwaway local database for benchmark.py
+    database_url = os.environ.get('databaseurl')
+    if database_url:
+        return database_url
+    database_password = os.environ.get('password')
+    server_address = os.environ.get('serverip')
+    return f"postgresql://postgres:{database_password}@{server_address}:5432/postgres"
+
+
+def get_engine(echo=False):
+    """
+    The process-wide SQLAlchemy engine, created (and .env loaded) on
+    first use. Every stage shares its connection pool instead of opening
+    its own. `echo` only applies to the call that creates it.
+    """
+    global _engine
+    with _lock:
+        if _engine is None:
+            _engine = create_engine(
+                connection_string(),
+                echo=echo,
+                pool_size=int(os.environ.get('dbpoolsize', 5)),
+                max_overflow=int(os.environ.get('dbpooloverflow', 5)),
+                # The container idles between triggers, stale connections are replaced instead of failing a stage
+                pool_pre_ping=True,
+            )
+            _instrument(_engine)
+        return _engine
+
+
+def _instrument(engine):
+    # Time every statement run through SQLAlchemy, labelled by its leading keyword
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        began = conn.info["query_started"].pop()
+        keyword = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else "empty"
+        metrics.db_query_seconds.observe(time.perf_counter() - began, statement=keyword)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # Failed statements never reach after_cursor_execute
+        if context.connection is not None and context.connection.info.get("query_started"):
+            context.connection.info["query_started"].pop()
@@ -0,0 +1,56 @@
+
+import numpy as np
+import pandas as pd
+
+
+HOUR_NS = 3_600_000_000_000
+
+
+def epoch_ns(index):
+    """
+    int64 nanoseconds since the epoch (UTC) of a DatetimeIndex.
+    """
+    return index.to_numpy(dtype="datetime64[ns]").view("i8")
+
+
+def bucket_first_last(timestamps, opens, closes, bucket_ns=HOUR_NS):
+    """
+    First open and last close per `bucket_ns` bucket of sorted int64
+    epoch `timestamps`.
+
+    Matches forward-filling the rows onto a contiguous grid before
+    resampling: every bucket between the first and last row is returned,
+    a bucket's open is the open of the last row at or before its start
+    (the first row for the first bucket) and its close is the close of
+    the last row before its end. Only the bucket-sized outputs and two
+    index arrays are allocated.
+    """
+    if len(timestamps) == 0:
+        empty = np.empty(0)
+        return np.empty(0, dtype=np.int64), empty, empty
+
+    first_bucket = timestamps[0] - timestamps[0] % bucket_ns
+    last_bucket = timestamps[-1] - timestamps[-1] % bucket_ns
+    starts = np.arange(first_bucket, last_bucket + bucket_ns, bucket_ns, dtype=np.int64)
+
+    open_rows = np.searchsorted(timestamps, starts, side="right") - 1
+    np.maximum(open_rows, 0, out=open_rows)
+    close_rows = np.searchsorted(timestamps, starts + bucket_ns, side="left") - 1
+
+    return starts, opens[open_rows], closes[close_rows]
+
+
+def resample_hourly(data):
+    """
+    Hourly first open / last close of a UTC-indexed frame with `open` and
+    `close` columns, with hours without rows carried forward.
+    """
+    starts, opens, closes = bucket_first_last(
+        epoch_ns(data.index),
+        data["open"].to_numpy(dtype=np.float64),
+        data["close"].to_numpy(dtype=np.float64),
+    )
+
+    index = pd.DatetimeIndex(starts.astype("datetime64[ns]")).tz_localize("UTC")
+    hourly = pd.DataFrame({"open": opens, "close": closes}, index=index)
+    return hourly.dropna()
@@ -0,0 +1,58 @@
+
+import logging
+
+from collections import OrderedDict
+
+import metrics
+
+
+class IndicatorCache:
+    """
+    Per-run LRU cache of indicator series keyed by
+    (symbol, interval, indicator, period), bounded by the total memory of
+    the cached values rather than by entry count.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            metrics.indicator_cache_lookups.inc(result="miss")
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        metrics.indicator_cache_lookups.inc(result="hit")
+        return entry[0]
+
+    def put(self, key, value, nbytes):
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+
+        # A value larger than the whole budget is not worth caching
+        if nbytes > self.max_bytes:
+            return
+
+        self.entries[key] = (value, nbytes)
+        self.bytes += nbytes
+
+        while self.bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self.entries.popitem(last=False)
+            self.bytes -= evicted_bytes
+            self.evictions += 1
+            metrics.indicator_cache_evictions.inc()
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        logging.info(
+            f"Indicator cache: {self.hits} hits, {self.misses} misses ({hit_rate:.0%} hit rate), "
+            f"{self.evictions} evictions, {len(self.entries)} entries using {self.bytes / 1024 / 1024:.1f} MB"
+        )
@@ -0,0 +1,66 @@
+
+import pytz
+
+from sqlalchemy import text
+
+
+def ensure_watermarks(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS ingest_watermarks (
+            symbol VARCHAR NOT NULL,
+            interval VARCHAR NOT NULL,
+            last_timestamp TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+            PRIMARY KEY (symbol, interval)
+        )
+        """))
+
+
+def get_watermarks(connection, interval="1m"):
+    """
+    Last committed candle per symbol for `interval`, as UTC timestamps.
+    """
+    result = connection.execute(
+        text("SELECT symbol, last_timestamp FROM ingest_watermarks WHERE interval = :interval"),
+        {"interval": interval},
+    )
+    return {row.symbol: pytz.utc.localize(row.last_timestamp) for row in result}
+
+
+def set_watermark(connection, symbol, interval, last_timestamp):
+    """
+    Advance the watermark for (symbol, interval). Call it in the same
+    transaction as the chunk write so a crash never leaves the watermark
+    ahead of the data.
+    """
+    if last_timestamp.tzinfo is not None:
+        last_timestamp = last_timestamp.astimezone(pytz.utc).replace(tzinfo=None)
+
+    connection.execute(text("""
+        INSERT INTO ingest_watermarks (symbol, interval, last_timestamp)
+        VALUES (:symbol, :interval, :last_timestamp)
+        ON CONFLICT (symbol, interval) DO UPDATE
+        SET last_timestamp = GREATEST(ingest_watermarks.last_timestamp, EXCLUDED.last_timestamp),
+            updated_at = now() AT TIME ZONE 'utc'
+        """), {"symbol": symbol, "interval": interval, "last_timestamp": last_timestamp})
+
+
+def get_resume_points(connection, interval="1m"):
+    """
+    Per symbol, the later of the newest market_data row and the
+    watermark: where the next download starts from.
+    """
+    result = connection.execute(text("""
+        SELECT symbol, MAX(timestamp) AS last_timestamp
+        FROM market_data
+        WHERE interval = :interval
+        GROUP BY symbol
+        """), {"interval": interval})
+    last_timestamps = {row.symbol: pytz.utc.localize(row.last_timestamp) for row in result}
+
+    # Resume from the last committed chunk when it is ahead of the data
+    for symbol, watermark in get_watermarks(connection, interval).items():
+        if symbol in last_timestamps:
+            last_timestamps[symbol] = max(last_timestamps[symbol], watermark)
+
+    return last_timestamps
@@ -0,0 +1,118 @@
+
+import os
+import time
+import logging
+import datetime
+import threading
+
+from contextlib import nullcontext
+
+import metrics
+
+
+class JobRunner:
+    """
+    Runs a list of (name, function) stages in order on a background
+    thread, one run at a time. A trigger that arrives while a run is in
+    flight joins that run instead of starting another, so overlapping
+    requests never download the same data twice or race on primary keys.
+
+    A failing stage is logged and recorded, and the next stage still runs.
+    A run triggered with `profile` is captured with cProfile into
+    `profile_dir`.
+    """
+
+    def __init__(self, stages, profile_dir="profiles"):
+        self.stages = list(stages)
+        self.profile_dir = profile_dir
+        self.lock = threading.Lock()
+        self.thread = None
+        self.runs = 0
+        self.coalesced = 0
+        self.current = None
+        self.last = None
+
+    def trigger(self, profile=False):
+        """
+        Start a run unless one is in flight. Returns (started, status).
+        """
+        with self.lock:
+            if self.current is not None:
+                self.coalesced += 1
+                self.current["coalesced_triggers"] += 1
+                metrics.job_coalesced_triggers.inc()
+                return False, self._status()
+
+            self.runs += 1
+            metrics.job_runs.inc()
+            self.current = {
+                "run": self.runs,
+                "started_at": _now(),
+                "finished_at": None,
+                "stage": None,
+                "stages": {},
+                "coalesced_triggers": 0,
+                "profile": os.path.join(self.profile_dir, f"run-{self.runs}.prof") if profile else None,
+            }
+            self.thread = threading.Thread(target=self._run, args=(self.current,), name=f"job-run-{self.runs}", daemon=True)
+            self.thread.start()
+            return True, self._status()
+
+    def _run(self, run):
+        logging.info(f"-----*----------*----------*-----")
+        logging.info(f"Starting task.")
+
+        profile = metrics.profiled(run["profile"]) if run["profile"] else nullcontext()
+        try:
+            with profile:
+                self._run_stages(run)
+        finally:
+            with self.lock:
+                run["stage"] = None
+                run["finished_at"] = _now()
+                self.last = run
+                self.current = None
+
+        logging.info(f"Task finished.")
+
+    def _run_stages(self, run):
+        for name, stage in self.stages:
+            with self.lock:
+                run["stage"] = name
+            began = time.perf_counter()
+            result = {"ok": True}
+            try:
+                logging.info(f"Running {name}...")
+                stage()
+            except Exception as e:
+                logging.error(f"PYTHON ERROR: {e}")
+                result = {"ok": False, "error": str(e)}
+                metrics.job_stage_failures.inc(stage=name)
+            elapsed = time.perf_counter() - began
+            metrics.job_stage_seconds.observe(elapsed, stage=name)
+            result["seconds"] = round(elapsed, 3)
+            with self.lock:
+                run["stages"][name] = result
+            logging.info(f"Finished {name}.")
+
+    def _status(self):
+        return {
+            "running": self.current is not None,
+            "current": {**self.current, "stages": dict(self.current["stages"])} if self.current is not None else None,
+            "last": self.last,
+            "runs": self.runs,
+            "coalesced_triggers": self.coalesced,
+        }
+
+    def status(self):
+        with self.lock:
+            return self._status()
+
+    def wait(self, timeout=None):
+        thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
@@ -0,0 +1,203 @@
+
+import time
+import logging
+import threading
+import queue
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import metrics
+from rate_limit import WeightBudget
+from binance_rest import KlineClient
+
+
+# Binance spot REST limit (request weight per rolling minute)
+BINANCE_WEIGHT_PER_MINUTE = 6000
+# Leave headroom for other clients sharing the same IP
+WEIGHT_BUDGET_FRACTION = 0.8
+
+# Candles per streamed chunk (about a week of 1m klines)
+CHUNK_CANDLES = 10_000
+
+INTERVAL_MINUTES = {
+    "1m": 1,
+    "3m": 3,
+    "5m": 5,
+    "15m": 15,
+    "30m": 30,
+    "1h": 60,
+    "2h": 120,
+    "4h": 240,
+    "6h": 360,
+    "8h": 480,
+    "12h": 720,
+    "1d": 1440,
+}
+
+
+def binance_budget(weight_per_minute=None):
+    """
+    Weight budget shared by the workers calling the Binance REST API,
+    BINANCE_WEIGHT_PER_MINUTE less headroom unless given.
+    """
+    return WeightBudget(weight_per_minute or BINANCE_WEIGHT_PER_MINUTE * WEIGHT_BUDGET_FRACTION)
+
+
+def binance_client(api_url=None):
+    """
+    Kline client for `api_url` (e.g. a local fake kline server such as
+    http://127.0.0.1:8000/api), the public Binance endpoint by default.
+    """
+    return KlineClient(api_url)
+
+
+def closed_candles(data, end, interval="1m"):
+    """
+    Drop the candle that is still forming at `end` (and anything after it).
+    """
+    if data is None or data.empty:
+        return data
+    step = pd.Timedelta(minutes=INTERVAL_MINUTES[interval])
+    return data[data.index + step <= pd.Timestamp(end)]
+
+
+def listing_timestamp(symbol, interval="1m", client=None):
+    return (client or KlineClient()).listing_timestamp(symbol, interval)
+
+
+def download_klines(symbol, start, end, interval="1m", budget=None, client=None):
+    return (client or KlineClient()).download(symbol, start, end, interval, budget)
+
+
+def iter_kline_chunks(symbol, start, end, interval="1m", chunk_candles=CHUNK_CANDLES,
+                      budget=None, client=None):
+    """
+    Yield closed klines for `symbol` between `start` (exclusive) and `end`
+    as DataFrames of at most `chunk_candles` rows, oldest first. Only one
+    chunk is held at a time, so memory stays flat however long the range
+    is. The client retries each page on its own.
+    """
+    client = client or KlineClient()
+
+    if start is None:
+        start = listing_timestamp(symbol, interval, client)
+        start = start - pd.Timedelta(minutes=INTERVAL_MINUTES[interval])
+
+    start = pd.Timestamp(start)
+    end = pd.Timestamp(end)
+    step = pd.Timedelta(minutes=INTERVAL_MINUTES[interval] * chunk_candles)
+
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + step, end)
+
+        data = download_klines(symbol, chunk_start, chunk_end, interval, budget, client)
+
+        # Chunk bounds are inclusive on Binance, keep (chunk_start, chunk_end]
+        data = data[data.index > chunk_start]
+        if chunk_end < end:
+            data = data[data.index <= chunk_end]
+        else:
+            data = closed_candles(data, end, interval)
+
+        if not data.empty:
+            yield data
+
+        chunk_start = chunk_end
+
+
+_DONE = object()
+
+
+def fetch_and_write(symbols, fetch, write, max_workers=4, queue_size=None):
+    """
+    Download `symbols` concurrently and write chunks as soon as they
+    arrive, so inserts for one symbol overlap downloads of the others.
+    `fetch(symbol)` yields DataFrame chunks in order, and
+    `write(symbol, chunk)` returns the number of rows written.
+
+    Downloaded chunks wait in a bounded queue, which caps memory at a few
+    chunks per worker. Writes happen on the calling thread, one at a time,
+    in the order each symbol produced them. A symbol whose write fails
+    stops downloading after the chunk in flight. Returns a dict of
+    per-symbol timings.
+    """
+    chunks = queue.Queue(maxsize=queue_size or 2 * max_workers)
+    timings = {
+        symbol: {"download_s": 0.0, "write_s": 0.0, "chunks": 0, "rows_fetched": 0, "rows_written": 0}
+        for symbol in symbols
+    }
+    # Set when a symbol's write failed, its producer stops between chunks
+    stopped = {symbol: threading.Event() for symbol in symbols}
+
+    def produce(symbol):
+        began = time.perf_counter()
+        iterator = None
+        try:
+            iterator = iter(fetch(symbol) or ())
+            while True:
+                began = time.perf_counter()
+                chunk = _DONE if stopped[symbol].is_set() else next(iterator, _DONE)
+                elapsed = time.perf_counter() - began
+                if chunk is _DONE:
+                    chunks.put((symbol, _DONE, elapsed))
+                    return
+                chunks.put((symbol, chunk, elapsed))
+        except Exception as e:
+            chunks.put((symbol, e, time.perf_counter() - began))
+        finally:
+            # Releases the client and whatever else the generator holds
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for symbol in symbols:
+            executor.submit(produce, symbol)
+
+        pending = len(symbols)
+        while pending:
+            symbol, chunk, elapsed = chunks.get()
+            timing = timings[symbol]
+            timing["download_s"] += elapsed
+
+            if chunk is _DONE:
+                pending -= 1
+                continue
+            if isinstance(chunk, Exception):
+                logging.error(f"Giving up on {symbol}: {chunk}")
+                timing["error"] = str(chunk)
+                pending -= 1
+                continue
+            if stopped[symbol].is_set():
+                continue
+
+            timing["chunks"] += 1
+            timing["rows_fetched"] += len(chunk)
+            metrics.market_data_download_seconds.observe(elapsed)
+            metrics.market_data_rows_fetched.inc(len(chunk))
+
+            began = time.perf_counter()
+            try:
+                written = write(symbol, chunk)
+                timing["rows_written"] += written
+                metrics.market_data_rows_written.inc(written)
+            except Exception as e:
+                # Later chunks would leave a hole behind the watermark, stop downloading them
+                logging.error(f"Could not write {symbol}: {e}")
+                timing["error"] = str(e)
+                stopped[symbol].set()
+            elapsed = time.perf_counter() - began
+            timing["write_s"] += elapsed
+            metrics.market_data_write_seconds.observe(elapsed)
+
+    for symbol in symbols:
+        t = timings[symbol]
+        logging.info(
+            f"{symbol}: downloaded {t['rows_fetched']} rows in {t['chunks']} chunk(s) in {t['download_s']:.2f}s, "
+            f"wrote {t['rows_written']} in {t['write_s']:.2f}s"
+        )
+
+    return timings
@@ -0,0 +1,236 @@
+import os
+import json
+import random
+import asyncio
+import logging
+import argparse
+import datetime
+
+import pytz
+import pandas as pd
+import websockets
+
+from db import get_engine
+from kline_fetcher import binance_budget, binance_client, iter_kline_chunks, fetch_and_write
+from rate_limit import with_retries
+from ingest_state import ensure_watermarks, get_resume_points
+from market_data_rollup import ensure_rollups
+from update_database import as_market_data, unique_symbol_freqs, write_klines
+
+
+DEFAULT_WS_URL = "wss://stream.binance.com:9443"
+
+# Binance allows up to 1024 streams per connection, smaller groups reconnect faster
+STREAMS_PER_CONNECTION = 200
+
+KLINE_COLUMNS = ["timestamp", "open", "high", "low", "close", "volume"]
+
+
+def parse_kline(message):
+    """
+    (symbol, row) of a closed kline event, raw or wrapped by a combined
+    stream. Returns None for candles that are still forming and for any
+    other message.
+    """
+    data = message.get("data", message)
+    kline = data.get("k")
+    if data.get("e") != "kline" or not kline or not kline.get("x"):
+        return None
+    row = (kline["t"], float(kline["o"]), float(kline["h"]), float(kline["l"]), float(kline["c"]), float(kline["v"]))
+    return kline["s"], row
+
+
+def klines_frame(rows_by_symbol):
+    """
+    One market_data frame out of {symbol: [row, ...]} with rows laid out
+    as KLINE_COLUMNS and timestamps in epoch milliseconds.
+    """
+    frames = []
+    for symbol, rows in rows_by_symbol.items():
+        frame = pd.DataFrame(rows, columns=KLINE_COLUMNS)
+        frame["symbol"] = symbol
+        frames.append(frame)
+    data = pd.concat(frames, ignore_index=True)
+    data["timestamp"] = pd.to_datetime(data["timestamp"], unit="ms", utc=True)
+    return data.set_index("timestamp")
+
+
+class KlineStream:
+    """
+    Long-running ingestion of closed 1m klines from the Binance websocket
+    streams, as an alternative to polling REST through update_database.
+
+    Closed candles are queued and written in micro-batches, whichever
+    comes first of `batch_rows` candles or `batch_seconds` after the
+    first queued one. Connections are reopened with backoff when they
+    drop, and every (re)connect fills the gap since each symbol's resume
+    point over REST while the stream is already being read, so no minute
+    falls between the two. Writes skip existing rows, so the overlap is
+    harmless.
+    """
+
+    def __init__(self, engine, symbols, url=DEFAULT_WS_URL, batch_rows=500, batch_seconds=2.0,
+                 api_url=None, backfill_workers=4, streams_per_connection=STREAMS_PER_CONNECTION):
+        self.engine = engine
+        self.symbols = list(symbols)
+        self.url = url.rstrip("/")
+        self.batch_rows = batch_rows
+        self.batch_seconds = batch_seconds
+        self.api_url = api_url
+        self.backfill_workers = backfill_workers
+        self.streams_per_connection = streams_per_connection
+        self.budget = binance_budget()
+        self.queue = None
+
+    def stream_url(self, symbols):
+        streams = "/".join(f"{symbol.lower()}@kline_1m" for symbol in symbols)
+        return f"{self.url}/stream?streams={streams}"
+
+    def resume_points(self, symbols):
+        with self.engine.begin() as connection:
+            points = get_resume_points(connection, "1m")
+        return {symbol: points.get(symbol) for symbol in symbols}
+
+    def backfill(self, resume_points, end):
+        """
+        Download and write the candles between each symbol's resume point
+        and `end` over REST. Symbols without data are left to
+        new_symbol_freq.py.
+        """
+        client = binance_client(self.api_url)
+        symbols = [symbol for symbol, start in resume_points.items() if start is not None and start < end]
+
+        def download_symbol(symbol):
+            for data in iter_kline_chunks(symbol, start=resume_points[symbol], end=end, interval="1m",
+                                          budget=self.budget, client=client):
+                yield as_market_data(data, symbol)
+
+        return fetch_and_write(symbols, download_symbol, lambda symbol, data: write_klines(self.engine, data),
+                               max_workers=self.backfill_workers)
+
+    async def _fill_gap(self, resume_points, end, previous):
+        """
+        Backfill from `resume_points` up to `end`. Returns the resume points
+        of the symbols it could not fill: streamed candles have already
+        moved their watermarks past the hole, so the next gap fill of the
+        connection starts those symbols from here instead.
+        """
+        # A gap fill still running from an earlier connection finishes first
+        if previous is not None:
+            unfilled, = await asyncio.gather(previous, return_exceptions=True)
+            if isinstance(unfilled, dict):
+                for symbol, start in unfilled.items():
+                    current = resume_points.get(symbol)
+                    resume_points[symbol] = start if current is None else min(start, current)
+        try:
+            timings = await asyncio.to_thread(self.backfill, resume_points, end)
+        except Exception as e:
+            logging.error(f"Gap fill failed, retrying it on the next connection: {e}")
+            return {symbol: start for symbol, start in resume_points.items() if start is not None}
+
+        rows = sum(timing["rows_written"] for timing in timings.values())
+        logging.info(f"Filled the gap of {len(timings)} symbols with {rows} rows.")
+        unfilled = {symbol: resume_points[symbol] for symbol, timing in timings.items() if "error" in timing}
+        if unfilled:
+            logging.error(f"Gap fill failed for {len(unfilled)} symbols, retrying them on the next connection.")
+        return unfilled
+
+    async def _connection(self, symbols):
+        url = self.stream_url(symbols)
+        gap_fill = None
+        delay = 1.0
+
+        while True:
+            try:
+                async with websockets.connect(url, ping_interval=20, ping_timeout=20) as socket:
+                    logging.info(f"Streaming klines of {len(symbols)} symbols.")
+                    delay = 1.0
+
+                    # Read the resume points before any streamed candle can move a watermark past the gap
+                    resume_points = await asyncio.to_thread(self.resume_points, symbols)
+                    end = datetime.datetime.now(pytz.utc)
+                    gap_fill = asyncio.create_task(self._fill_gap(resume_points, end, gap_fill))
+
+                    async for message in socket:
+                        kline = parse_kline(json.loads(message))
+                        if kline is not None:
+                            await self.queue.put(kline)
+
+                logging.warning("Kline stream closed by the server.")
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+                logging.warning(f"Kline stream dropped: {e}")
+
+            await asyncio.sleep(delay * (0.5 + random.random()))
+            delay = min(60.0, delay * 2)
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        batch = {}
+        rows = 0
+        deadline = None
+
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            try:
+                symbol, row = await asyncio.wait_for(self.queue.get(), timeout)
+                batch.setdefault(symbol, []).append(row)
+                rows += 1
+                if deadline is None:
+                    deadline = loop.time() + self.batch_seconds
+            except asyncio.TimeoutError:
+                pass
+
+            if rows < self.batch_rows and (deadline is None or loop.time() < deadline):
+                continue
+
+            data = klines_frame(batch)
+            while True:
+                try:
+                    await asyncio.to_thread(
+                        with_retries, lambda: write_klines(self.engine, data), description=f"Write of {rows} streamed klines")
+                    break
+                except Exception as e:
+                    # Retry the same batch without reading the queue, so it fills up and pushes back on the sockets
+                    logging.error(f"Could not write {rows} streamed klines, retrying in {self.batch_seconds}s: {e}")
+                    await asyncio.sleep(self.batch_seconds)
+
+            logging.info(f"Wrote {rows} streamed klines of {len(batch)} symbols.")
+            batch = {}
+            rows = 0
+            deadline = None
+
+    async def run(self):
+        with self.engine.begin() as connection:
+            ensure_watermarks(connection)
+            ensure_rollups(connection)
+
+        # Bounded so a stalled database pushes back on the sockets instead of growing memory
+        self.queue = asyncio.Queue(maxsize=max(10 * self.batch_rows, len(self.symbols)))
+        groups = [
+            self.symbols[i:i + self.streams_per_connection]
+            for i in range(0, len(self.symbols), self.streams_per_connection)
+        ]
+        await asyncio.gather(self._writer(), *(self._connection(group) for group in groups))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stream closed 1m klines into market_data")
+
+    parser.add_argument('-symbol', required=False, action='append', help='Symbol to stream (default: all in market_data)')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    engine = get_engine()
+
+    stream = KlineStream(
+        engine,
+        args.symbol or unique_symbol_freqs(engine),
+        url=os.environ.get('binancewsurl') or DEFAULT_WS_URL,
+        batch_rows=int(os.environ.get('streambatchrows', 500)),
+        batch_seconds=float(os.environ.get('streambatchseconds', 2)),
+        api_url=os.environ.get('binanceapiurl'),
+        backfill_workers=int(os.environ.get('downloadworkers', 4)),
+    )
+    asyncio.run(stream.run())
@@ -0,0 +1,178 @@
+import os
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+
+from db import get_engine
+from pg_binary import copy_columns
+from kline_fetcher import INTERVAL_MINUTES, binance_budget, binance_client, iter_kline_chunks, fetch_and_write
+from update_database import as_market_data, unique_symbol_freqs, write_klines
+
+
+def find_gaps(timestamps, step, start=None, end=None):
+    """
+    Missing candles in sorted int64 epoch-ns `timestamps` spaced `step`
+    ns apart, as (first_missing, last_missing, count) tuples of epoch ns.
+    `start` and `end` (epoch ns, inclusive) also report the candles
+    missing before the first and after the last timestamp.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    if len(timestamps) == 0:
+        if start is None or end is None or end < start:
+            return []
+        return [(start, end, (end - start) // step + 1)]
+
+    # Sentinels one step outside the range turn leading/trailing holes into ordinary gaps
+    bounded = timestamps
+    if start is not None and start < timestamps[0]:
+        bounded = np.concatenate([[start - step], bounded])
+    if end is not None and end > timestamps[-1]:
+        bounded = np.concatenate([bounded, [end + step]])
+
+    deltas = np.diff(bounded)
+    holes = np.flatnonzero(deltas > step)
+    firsts = bounded[holes] + step
+    lasts = bounded[holes + 1] - step
+    counts = deltas[holes] // step - 1
+    return list(zip(firsts.tolist(), lasts.tolist(), counts.tolist()))
+
+
+def read_timestamps(connection, symbol, interval="1m", start=None, end=None):
+    conditions = ["symbol = %(symbol)s", "interval = %(interval)s"]
+    params = {"symbol": symbol, "interval": interval}
+    if start is not None:
+        conditions.append("timestamp >= %(start)s")
+        params["start"] = start
+    if end is not None:
+        conditions.append("timestamp <= %(end)s")
+        params["end"] = end
+
+    # Index-only scan of the primary key, decoded straight into an int64 array
+    (timestamps,) = copy_columns(
+        connection,
+        f"SELECT timestamp FROM market_data WHERE {' AND '.join(conditions)} ORDER BY timestamp",
+        params,
+        ["timestamp"],
+        table="market_data",
+    )
+    return timestamps
+
+
+def scan(engine, symbols, interval="1m", since=None, until=None):
+    """
+    Gaps and coverage of every symbol's `interval` candles between
+    `since` (default: its first candle) and `until` (default: its last
+    candle). Returns {symbol: {"gaps": [...], "expected": n, "present": n}}
+    with gaps as (first_missing, last_missing, count) UTC Timestamps.
+    """
+    step = INTERVAL_MINUTES[interval] * 60 * 10**9
+    start = _epoch_ns(since)
+    end = _epoch_ns(until)
+
+    report = {}
+    for symbol in symbols:
+        with engine.connect() as connection:
+            timestamps = read_timestamps(connection, symbol, interval, _naive(start), _naive(end))
+
+        gaps = find_gaps(timestamps, step, start, end)
+        first = start if start is not None else (timestamps[0] if len(timestamps) else None)
+        last = end if end is not None else (timestamps[-1] if len(timestamps) else None)
+        expected = 0 if first is None or last < first else (last - first) // step + 1
+
+        report[symbol] = {
+            "gaps": [(_utc(a), _utc(b), int(count)) for a, b, count in gaps],
+            "expected": int(expected),
+            "present": len(timestamps),
+        }
+        logging.info(f"{symbol}: {len(gaps)} gaps, {sum(gap[2] for gap in gaps)} missing candles")
+
+    return report
+
+
+def backfill(engine, report, interval="1m", max_workers=4, api_url=None):
+    """
+    Download every gap in `report` (from scan) over REST, gaps of
+    different symbols concurrently. Returns fetch_and_write's per-symbol
+    timings.
+    """
+    budget = binance_budget()
+    client = binance_client(api_url)
+    step = pd.Timedelta(minutes=INTERVAL_MINUTES[interval])
+    symbols = [symbol for symbol, coverage in report.items() if coverage["gaps"]]
+
+    def download_symbol(symbol):
+        for first, last, _ in report[symbol]["gaps"]:
+            # iter_kline_chunks yields closed candles in (start, end]
+            chunks = iter_kline_chunks(symbol, start=first - step, end=last + step, interval=interval,
+                                       budget=budget, client=client)
+            for data in chunks:
+                yield as_market_data(data, symbol)
+
+    return fetch_and_write(symbols, download_symbol, lambda symbol, data: write_klines(engine, data),
+                           max_workers=max_workers)
+
+
+def coverage_table(before, after=None):
+    rows = []
+    for symbol, coverage in before.items():
+        row = {
+            "symbol": symbol,
+            "expected": coverage["expected"],
+            "gaps": len(coverage["gaps"]),
+            "missing": sum(gap[2] for gap in coverage["gaps"]),
+            "coverage_%": 100.0 * coverage["present"] / coverage["expected"] if coverage["expected"] else 100.0,
+        }
+        if after is not None:
+            repaired = after[symbol]
+            row["gaps_after"] = len(repaired["gaps"])
+            row["missing_after"] = sum(gap[2] for gap in repaired["gaps"])
+            row["coverage_after_%"] = (
+                100.0 * repaired["present"] / repaired["expected"] if repaired["expected"] else 100.0
+            )
+        rows.append(row)
+    return pd.DataFrame(rows).set_index("symbol").round(4)
+
+
+def _epoch_ns(timestamp):
+    if timestamp is None:
+        return None
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert("UTC").tz_localize(None)
+    return timestamp.value
+
+
+def _utc(epoch_ns):
+    return pd.Timestamp(epoch_ns, unit="ns", tz="UTC")
+
+
+def _naive(epoch_ns):
+    return None if epoch_ns is None else pd.Timestamp(epoch_ns, unit="ns").to_pydatetime()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find and backfill missing 1m candles in market_data")
+
+    parser.add_argument('-symbol', required=False, action='append', help='Symbol to check (default: all)')
+    parser.add_argument('-since', required=False, help='Start of the checked range (default: first candle)')
+    parser.add_argument('-until', required=False, help='End of the checked range (default: last candle)')
+    parser.add_argument('-scanonly', required=False, action='store_true', help='Report gaps without backfilling')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    engine = get_engine()
+
+    symbols = args.symbol or unique_symbol_freqs(engine)
+    before = scan(engine, symbols, since=args.since, until=args.until)
+
+    if args.scanonly:
+        print(coverage_table(before).to_string())
+    else:
+        backfill(engine, before, max_workers=int(os.environ.get('downloadworkers', 4)),
+                 api_url=os.environ.get('binanceapiurl'))
+        after = scan(engine, symbols, since=args.since, until=args.until)
+        print(coverage_table(before, after).to_string())
@@ -0,0 +1,124 @@
+
+import argparse
+import logging
+
+import pandas as pd
+
+from sqlalchemy import text
+
+from db import get_engine
+from pg_binary import _naive_utc
+from zlema_engine import invalidate_states
+
+
+# Aggregate tables kept next to market_data, by interval and date_trunc unit
+ROLLUP_INTERVALS = {
+    "1h": "hour",
+    "1d": "day",
+}
+
+
+def rollup_table(interval):
+    return f"market_data_{interval}"
+
+
+def ensure_rollups(connection):
+    for interval in ROLLUP_INTERVALS:
+        connection.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {rollup_table(interval)} (
+                timestamp TIMESTAMP NOT NULL,
+                symbol VARCHAR NOT NULL,
+                open DOUBLE PRECISION,
+                high DOUBLE PRECISION,
+                low DOUBLE PRECISION,
+                close DOUBLE PRECISION,
+                volume DOUBLE PRECISION,
+                PRIMARY KEY (symbol, timestamp)
+            )
+            """))
+
+
+def refresh_rollups(connection, symbol, since, until=None):
+    """
+    Recompute the rollup buckets of `symbol` touched by 1m rows between
+    `since` and `until` (inclusive, naive UTC or tz-aware), and drop the
+    indicator states built on them. Runs in the caller's transaction, so
+    call it right after writing those rows.
+    """
+    since = _naive_utc(since)
+    until = _naive_utc(until) if until is not None else None
+
+    params = {"symbol": symbol, "since": since}
+    if until is not None:
+        params["until"] = until
+
+    for interval, unit in ROLLUP_INTERVALS.items():
+        upper_bound = ""
+        if until is not None:
+            upper_bound = f"AND timestamp < date_trunc('{unit}', :until) + interval '1 {unit}'"
+
+        connection.execute(text(f"""
+            INSERT INTO {rollup_table(interval)} (timestamp, symbol, open, high, low, close, volume)
+            SELECT
+                date_trunc('{unit}', timestamp) AS bucket,
+                symbol,
+                (array_agg(open ORDER BY timestamp))[1],
+                MAX(high),
+                MIN(low),
+                (array_agg(close ORDER BY timestamp DESC))[1],
+                SUM(volume)
+            FROM market_data
+            WHERE symbol = :symbol
+                AND interval = '1m'
+                AND timestamp >= date_trunc('{unit}', :since)
+                {upper_bound}
+            GROUP BY bucket, symbol
+            ON CONFLICT (symbol, timestamp) DO UPDATE
+            SET open = EXCLUDED.open,
+                high = EXCLUDED.high,
+                low = EXCLUDED.low,
+                close = EXCLUDED.close,
+                volume = EXCLUDED.volume
+            """), params)
+
+    invalidate_states(connection, symbol, since)
+
+
+def rebuild(engine, symbols=None, months_per_batch=3):
+    """
+    Build the rollups from scratch out of market_data, a few months per
+    transaction.
+    """
+    with engine.begin() as connection:
+        ensure_rollups(connection)
+        result = connection.execute(text("""
+            SELECT symbol, MIN(timestamp) AS first_timestamp, MAX(timestamp) AS last_timestamp
+            FROM market_data
+            WHERE interval = '1m'
+            GROUP BY symbol
+            """))
+        ranges = [row for row in result if symbols is None or row.symbol in symbols]
+
+    for row in ranges:
+        # Batches start on month boundaries so no day/hour bucket is split
+        batch_start = pd.Timestamp(row.first_timestamp).to_period("M").to_timestamp()
+        while batch_start <= row.last_timestamp:
+            batch_end = batch_start + pd.DateOffset(months=months_per_batch)
+            with engine.begin() as connection:
+                refresh_rollups(connection, row.symbol, batch_start, batch_end - pd.Timedelta(minutes=1))
+            logging.info(f"Rolled up {row.symbol} until {batch_end}")
+            batch_start = batch_end
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild the market_data rollup tables")
+
+    parser.add_argument('-symbol', required=False, action='append', help='Symbol to rebuild (default: all)')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    engine = get_engine()
+
+    rebuild(engine, args.symbol)
@@ -0,0 +1,176 @@
+
+import os
+import time
+import bisect
+import logging
+import cProfile
+import threading
+
+from contextlib import contextmanager
+
+
+# Seconds, from a fast query to a full backfill
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+REGISTRY = []
+
+
+class Metric:
+    """
+    Base of the in-process metrics below: a value per combination of
+    label values, rendered in the Prometheus text exposition format.
+    Thread-safe. Observations made in process pool workers (botworkers
+    above 1) stay in those processes and are not reported.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+    def _samples(self):
+        return [f"{self.name}{self._labels(key)} {_number(value)}" for key, value in sorted(self.values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            # Per-bucket counts with an overflow slot, made cumulative when rendered
+            counts, total = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - began, **labels)
+
+    def count(self, **labels):
+        with self.lock:
+            counts, _ = self.values.get(self._key(labels)) or ([0], 0.0)
+            return sum(counts)
+
+    def _samples(self):
+        lines = []
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._labels(key, [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {_number(total)}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render():
+    """
+    Every metric in the Prometheus text format, for the /metrics route.
+    """
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+@contextmanager
+def profiled(path):
+    """
+    Profile the calling thread with cProfile and dump the stats to `path`
+    (readable with pstats or snakeviz). Threads and processes the block
+    starts are not profiled.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        logging.info(f"Saved profile to {path}")
+
+
+# Pipeline metrics, updated where the work happens
+
+job_runs = Counter("job_runs_total", "Runs started by the job runner")
+job_coalesced_triggers = Counter("job_coalesced_triggers_total", "Triggers that joined a run already in flight")
+job_stage_seconds = Histogram("job_stage_seconds", "Duration of each job stage", ["stage"])
+job_stage_failures = Counter("job_stage_failures_total", "Job stages that raised", ["stage"])
+
+binance_request_seconds = Histogram(
+    "binance_request_seconds", "Latency of Binance REST requests, per attempt", ["path", "outcome"]
+)
+binance_request_retries = Counter("binance_request_retries_total", "Binance REST requests retried", ["path", "reason"])
+
+market_data_download_seconds = Histogram("market_data_download_seconds", "Time to download one chunk of klines")
+market_data_write_seconds = Histogram("market_data_write_seconds", "Time to write one chunk of klines")
+market_data_rows_fetched = Counter("market_data_rows_fetched_total", "Kline rows downloaded")
+market_data_rows_written = Counter("market_data_rows_written_total", "Kline rows inserted")
+
+db_query_seconds = Histogram("db_query_seconds", "Duration of SQL statements run through the engine", ["statement"])
+db_copy_seconds = Histogram("db_copy_seconds", "Duration of COPY transfers", ["table", "direction"])
+db_copy_rows = Counter("db_copy_rows_total", "Rows moved by COPY (inserted rows for direction=in)", ["table", "direction"])
+
+bot_compute_seconds = Histogram("bot_compute_seconds", "Time to compute one bot's positions", ["strategy"])
+zlema_bars = Counter("zlema_bars_total", "Hourly bars stepped through by the incremental ZLEMA")
+
+indicator_cache_lookups = Counter("indicator_cache_lookups_total", "Indicator cache lookups", ["result"])
+indicator_cache_evictions = Counter("indicator_cache_evictions_total", "Indicator series evicted from the cache")
+price_cache_rows = Counter("price_cache_rows_total", "Price rows served by sync, from the local cache or the database", ["source"])
+price_cache_invalidations = Counter("price_cache_invalidations_total", "Symbol caches dropped because upstream rows changed")
+query_cache_lookups = Counter("query_cache_lookups_total", "Response cache lookups of the /ohlcv and /positions routes", ["result"])
+price_store_evictions = Counter("price_store_evictions_total", "Symbols dropped from run_bots' price store to stay in its byte budget")
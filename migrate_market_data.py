@@ -0,0 +1,183 @@
+import argparse
+import logging
+import datetime
+
+import pandas as pd
+
+from sqlalchemy import text
+
+from db import get_engine
+from market_data_schema import (
+    SCHEMA_VERSION, PARTITIONS_FROM, create_market_data_table, ensure_partitions, existing_partitions,
+    get_schema_version, set_schema_version,
+)
+
+
+NEW_TABLE = "market_data_partitioned"
+LEGACY_TABLE = "market_data_legacy"
+
+COLUMNS = "timestamp, open, high, low, close, volume, symbol, interval"
+
+
+def column_names(connection, table):
+    result = connection.execute(
+        text("SELECT column_name FROM information_schema.columns WHERE table_name = :table"),
+        {"table": table},
+    )
+    return {row.column_name for row in result}
+
+
+def ensure_checkpoints(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS migration_checkpoints (
+            name VARCHAR NOT NULL,
+            position TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+            PRIMARY KEY (name)
+        )
+        """))
+
+
+def get_checkpoint(connection, name):
+    result = connection.execute(text("SELECT position FROM migration_checkpoints WHERE name = :name"), {"name": name})
+    return result.scalar()
+
+
+def set_checkpoint(connection, name, position):
+    connection.execute(text("""
+        INSERT INTO migration_checkpoints (name, position)
+        VALUES (:name, :position)
+        ON CONFLICT (name) DO UPDATE
+        SET position = EXCLUDED.position,
+            updated_at = now() AT TIME ZONE 'utc'
+        """), {"name": name, "position": position})
+
+
+def prepare(engine):
+    """
+    Give the live market_data an interval column, create the partitioned
+    copy and mirror every new insert into it. All steps only take brief
+    locks, ingestion keeps running.
+    """
+    with engine.begin() as connection:
+        columns = column_names(connection, "market_data")
+        if "interval" not in columns:
+            if "frequency" in columns:
+                connection.execute(text("ALTER TABLE market_data RENAME COLUMN frequency TO interval"))
+            else:
+                # A constant default doesn't rewrite the table
+                connection.execute(text("ALTER TABLE market_data ADD COLUMN interval VARCHAR NOT NULL DEFAULT '1m'"))
+        connection.execute(text("ALTER TABLE market_data ALTER COLUMN interval SET DEFAULT '1m'"))
+
+        create_market_data_table(connection, NEW_TABLE)
+        ensure_partitions(connection, PARTITIONS_FROM, datetime.datetime.utcnow(), NEW_TABLE)
+
+        connection.execute(text(f"""
+            CREATE OR REPLACE FUNCTION market_data_mirror() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                INSERT INTO {NEW_TABLE} ({COLUMNS})
+                SELECT timestamp, open, high, low, close, volume, symbol, COALESCE(interval, '1m')
+                FROM new_rows
+                ON CONFLICT DO NOTHING;
+                RETURN NULL;
+            END
+            $$
+            """))
+        connection.execute(text("DROP TRIGGER IF EXISTS market_data_mirror ON market_data"))
+        connection.execute(text("""
+            CREATE TRIGGER market_data_mirror
+            AFTER INSERT ON market_data
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION market_data_mirror()
+            """))
+
+        ensure_checkpoints(connection)
+
+    logging.info(f"Prepared {NEW_TABLE}, new market_data rows are mirrored into it.")
+
+
+def copy_history(engine, batch=pd.Timedelta(days=7)):
+    """
+    Copy the rows that existed before the mirror trigger, `batch` of time
+    per transaction. The last copied position is checkpointed, so an
+    interrupted run continues where it stopped.
+    """
+    with engine.begin() as connection:
+        result = connection.execute(text("SELECT MIN(timestamp) AS first, MAX(timestamp) AS last FROM market_data"))
+        bounds = result.one()
+        position = get_checkpoint(connection, NEW_TABLE) or bounds.first
+
+    if bounds.last is None:
+        return
+
+    position = pd.Timestamp(position)
+    last = pd.Timestamp(bounds.last)
+    while position <= last:
+        batch_end = position + batch
+        with engine.begin() as connection:
+            # The old key leads with timestamp, so each batch is an index range scan
+            result = connection.execute(text(f"""
+                INSERT INTO {NEW_TABLE} ({COLUMNS})
+                SELECT timestamp, open, high, low, close, volume, symbol, COALESCE(interval, '1m')
+                FROM market_data
+                WHERE timestamp >= :start AND timestamp < :end
+                ON CONFLICT DO NOTHING
+                """), {"start": position.to_pydatetime(), "end": batch_end.to_pydatetime()})
+            set_checkpoint(connection, NEW_TABLE, batch_end.to_pydatetime())
+        logging.info(f"Copied {result.rowcount} rows up to {batch_end}")
+        position = batch_end
+
+
+def swap(engine):
+    """
+    Replace market_data with the partitioned copy in one short
+    transaction. The old table stays as market_data_legacy until it is
+    dropped by hand.
+    """
+    with engine.begin() as connection:
+        # Writers wait for the swap, readers keep going until the rename
+        connection.execute(text("LOCK TABLE market_data IN SHARE ROW EXCLUSIVE MODE"))
+        connection.execute(text("DROP TRIGGER market_data_mirror ON market_data"))
+        connection.execute(text("DROP FUNCTION market_data_mirror()"))
+
+        connection.execute(text(f"ALTER TABLE market_data RENAME TO {LEGACY_TABLE}"))
+        connection.execute(text(f"ALTER TABLE {NEW_TABLE} RENAME TO market_data"))
+        connection.execute(text(f"ALTER INDEX {NEW_TABLE}_timestamp_brin RENAME TO market_data_timestamp_brin"))
+
+        # ensure_partitions looks partitions up by name
+        for name in existing_partitions(connection, "market_data"):
+            if name.startswith(NEW_TABLE + "_"):
+                connection.execute(text(f"ALTER TABLE {name} RENAME TO market_data{name[len(NEW_TABLE):]}"))
+
+        set_schema_version(connection, SCHEMA_VERSION)
+
+    logging.info(f"market_data is now at schema version {SCHEMA_VERSION}, the old table is {LEGACY_TABLE}.")
+
+
+def migrate(engine, batch=pd.Timedelta(days=7), swap_tables=True):
+    with engine.begin() as connection:
+        version = get_schema_version(connection)
+    if version >= SCHEMA_VERSION:
+        logging.info(f"market_data is already at schema version {version}.")
+        return
+
+    prepare(engine)
+    copy_history(engine, batch)
+    if swap_tables:
+        swap(engine)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Migrate market_data to the partitioned schema while it stays in use")
+
+    parser.add_argument('-batchdays', required=False, type=float, default=7, help='Days of candles copied per transaction')
+    parser.add_argument('-noswap', required=False, action='store_true', help='Copy only, leave the swap for a later run')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    engine = get_engine()
+
+    migrate(engine, pd.Timedelta(days=args.batchdays), not args.noswap)
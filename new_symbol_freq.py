@@ -1,77 +1,240 @@
 import os
 import argparse
 
-import vectorbt as vbt
+import pytz
+import datetime
 
-from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+import pandas as pd
 
+from sqlalchemy import text
 
-load_dotenv()
-database_password = os.environ.get('password')
-server_address = os.environ.get('serverip')
-connection_string = f"postgresql://postgres:{database_password}@{server_address}:5432/postgres"
-engine = create_engine(connection_string,echo=True)
+from db import get_engine
+from bulk_write import copy_frame
+from kline_fetcher import (
+    INTERVAL_MINUTES, binance_budget, binance_client, fetch_and_write, iter_kline_chunks, listing_timestamp,
+)
+from ingest_state import ensure_watermarks, get_watermarks, set_watermark
+from market_data_rollup import ensure_rollups, refresh_rollups
+from market_data_schema import ensure_partitions
+
+
+engine = get_engine()
+
+# Days of candles per bootstrap shard
+SHARD_DAYS = 90
+
+
+def ensure_bootstrap_shards(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS bootstrap_shards (
+            symbol VARCHAR NOT NULL,
+            interval VARCHAR NOT NULL,
+            shard_start TIMESTAMP NOT NULL,
+            shard_end TIMESTAMP NOT NULL,
+            position TIMESTAMP NOT NULL,
+            completed BOOLEAN NOT NULL DEFAULT FALSE,
+            PRIMARY KEY (symbol, interval, shard_start)
+        )
+        """))
 
 
 def check_symbol_freq(symbol, freq):
-    
-    sql_query = text("SELECT COUNT(*) FROM market_data WHERE symbol = :symbol AND frequency = :freq")
-    
 
-    # Using engine.connect()
+    # Stops at the first matching key of the (symbol, interval, timestamp) primary key
+    sql_query = text("SELECT EXISTS (SELECT 1 FROM market_data WHERE symbol = :symbol AND interval = :freq)")
+
     with engine.begin() as connection:
         result = connection.execute(sql_query, {'symbol': symbol,'freq': freq})
-        count = result.scalar()  # Get the first column of the first row (should be the COUNT)
-    
-    if count==0:
-        return False
-    else:
-        return True
+        return result.scalar()
 
 
 
-def write_to_database(data, symbol, freq):
+def write_to_database(data, symbol, freq, shard_start=None):
+    """
+    Write one chunk together with its progress marker: the shard's
+    position during a bootstrap, the watermark otherwise.
+    """
 
     dataIn = data.copy()
 
     dataIn.columns = ['open', 'high', 'low', 'close', 'volume']
 
-    dataIn['frequency'] = freq
+    dataIn['interval'] = freq
     dataIn['symbol'] = symbol
 
     dataIn.index.name = 'timestamp'
-    
-    with engine.begin() as connection:
-        dataIn.to_sql('market_data', connection, if_exists='append', index=True)
-      
 
+    position = dataIn.index.max()
+    if position.tzinfo is not None:
+        position = position.tz_convert("UTC").tz_localize(None)
 
+    with engine.begin() as connection:
+        ensure_partitions(connection, dataIn.index.min(), dataIn.index.max())
+        written = copy_frame(connection, dataIn, 'market_data', index=True)
+        if shard_start is None:
+            set_watermark(connection, symbol, freq, dataIn.index.max())
+        else:
+            connection.execute(text("""
+                UPDATE bootstrap_shards
+                SET position = GREATEST(position, :position)
+                WHERE symbol = :symbol AND interval = :interval AND shard_start = :shard_start
+                """), {
+                    "symbol": symbol,
+                    "interval": freq,
+                    "shard_start": shard_start,
+                    "position": position.to_pydatetime(),
+                })
+        if freq == "1m":
+            refresh_rollups(connection, symbol, dataIn.index.min(), dataIn.index.max())
+
+    return written
+
+
+def plan_shards(symbol, freq, end_timestamp, shard_days=SHARD_DAYS, client=None):
+    """
+    Split listing-to-`end_timestamp` into shards of `shard_days` and
+    record them. Each shard covers (shard_start, shard_end].
+    """
+    listed = listing_timestamp(symbol, freq, client)
+    first = listed.tz_convert("UTC").tz_localize(None) - pd.Timedelta(minutes=INTERVAL_MINUTES[freq])
+    end = pd.Timestamp(end_timestamp).tz_convert("UTC").tz_localize(None)
+
+    bounds = list(pd.date_range(first, end, freq=pd.Timedelta(days=shard_days)))
+    if bounds[-1] < end:
+        bounds.append(end)
+
+    shards = [
+        {"symbol": symbol, "interval": freq, "shard_start": a.to_pydatetime(), "shard_end": b.to_pydatetime()}
+        for a, b in zip(bounds[:-1], bounds[1:])
+    ]
+    with engine.begin() as connection:
+        for shard in shards:
+            connection.execute(text("""
+                INSERT INTO bootstrap_shards (symbol, interval, shard_start, shard_end, position)
+                VALUES (:symbol, :interval, :shard_start, :shard_end, :shard_start)
+                ON CONFLICT DO NOTHING
+                """), shard)
 
-def main(symbol, freq):
-    if not check_symbol_freq(symbol, freq):
 
-        print(f"symbol {symbol}, frequency {freq} not found. inserting...")
+def get_shards(symbol, freq):
+    with engine.begin() as connection:
+        result = connection.execute(text("""
+            SELECT shard_start, shard_end, position, completed
+            FROM bootstrap_shards
+            WHERE symbol = :symbol AND interval = :interval
+            ORDER BY shard_start
+            """), {"symbol": symbol, "interval": freq})
+        return result.fetchall()
+
+
+def bootstrap(symbol, freq, shard_days=SHARD_DAYS, workers=4, api_url=None):
+    """
+    Download a symbol's whole history as time shards in parallel. Every
+    chunk commits with its shard's position, so a rerun only fetches what
+    is still missing. Once all shards are done the watermark takes over
+    and the shard plan is dropped.
+    """
+    budget = binance_budget()
+    client = binance_client(api_url)
+    now = datetime.datetime.now(pytz.utc)
+    step = pd.Timedelta(minutes=INTERVAL_MINUTES[freq])
+
+    if not get_shards(symbol, freq):
+        plan_shards(symbol, freq, now, shard_days, client)
+
+    shards = {
+        f"{symbol} {freq} {shard.shard_start:%Y-%m-%d}": shard
+        for shard in get_shards(symbol, freq) if not shard.completed
+    }
+    print(f"symbol {symbol}, frequency {freq}: {len(shards)} shard(s) to download")
+
+    def download_shard(key):
+        shard = shards[key]
+        # The candle opening at shard_end only counts as closed one step later
+        return iter_kline_chunks(
+            symbol,
+            start=pytz.utc.localize(shard.position),
+            end=min(pytz.utc.localize(shard.shard_end) + step, now),
+            interval=freq,
+            budget=budget,
+            client=client,
+        )
+
+    def write_shard(key, data):
+        return write_to_database(data, symbol, freq, shards[key].shard_start)
+
+    timings = fetch_and_write(list(shards), download_shard, write_shard, max_workers=workers)
 
-        data = vbt.BinanceData.download(
-            symbols=symbol,
-            interval=freq
-            ).get(["Open","High","Low","Close","Volume"])
-        data = data.iloc[:-1,:]
+    with engine.begin() as connection:
+        for key, timing in timings.items():
+            if "error" not in timing:
+                connection.execute(text("""
+                    UPDATE bootstrap_shards SET completed = TRUE
+                    WHERE symbol = :symbol AND interval = :interval AND shard_start = :shard_start
+                    """), {"symbol": symbol, "interval": freq, "shard_start": shards[key].shard_start})
+
+    remaining = [shard for shard in get_shards(symbol, freq) if not shard.completed]
+    if remaining:
+        print(f"symbol {symbol}, frequency {freq}: {len(remaining)} shard(s) failed, rerun to resume")
+        return timings
 
+    with engine.begin() as connection:
+        last = connection.execute(
+            text("SELECT MAX(timestamp) FROM market_data WHERE symbol = :symbol AND interval = :interval"),
+            {"symbol": symbol, "interval": freq},
+        ).scalar()
+        if last is not None:
+            set_watermark(connection, symbol, freq, last)
+        connection.execute(
+            text("DELETE FROM bootstrap_shards WHERE symbol = :symbol AND interval = :interval"),
+            {"symbol": symbol, "interval": freq},
+        )
+    print(f"symbol {symbol}, frequency {freq} bootstrapped up to {last}")
+
+    return timings
+
+
+def main(symbol, freq, shard_days=SHARD_DAYS, workers=4):
+    with engine.begin() as connection:
+        ensure_watermarks(connection)
+        ensure_rollups(connection)
+        ensure_bootstrap_shards(connection)
+        watermark = get_watermarks(connection, freq).get(symbol)
+
+    api_url = os.environ.get('binanceapiurl')
+
+    if watermark is None:
+        if get_shards(symbol, freq):
+            print(f"symbol {symbol}, frequency {freq} resuming bootstrap...")
+        elif check_symbol_freq(symbol, freq):
+            print(f"symbol {symbol} and frequency {freq} already in database")
+            return
+        else:
+            print(f"symbol {symbol}, frequency {freq} not found. inserting...")
+        bootstrap(symbol, freq, shard_days, workers, api_url)
+        return
+
+    print(f"symbol {symbol}, frequency {freq} resuming from {watermark}...")
+
+    end_timestamp = datetime.datetime.now(pytz.utc)
+
+    # Each chunk is committed with its watermark, so a rerun continues from the last one
+    for data in iter_kline_chunks(symbol, start=watermark, end=end_timestamp, interval=freq,
+                                  client=binance_client(api_url)):
         write_to_database(data, symbol, freq)
-    else:
-        print(f"symbol {symbol} and frequency {freq} already in database")
+        print(f"{symbol} {freq} written up to {data.index.max()}")
 
 
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="My script description")
-    
+
     parser.add_argument('-symbol', required=True, help='First argument')
-    parser.add_argument('-freq', required=False, help='Second argument', default="default_value")
-    
+    parser.add_argument('-freq', required=False, help='Second argument', default="1m")
+    parser.add_argument('-sharddays', required=False, type=int, default=SHARD_DAYS, help='Days of candles per bootstrap shard')
+    parser.add_argument('-workers', required=False, type=int, default=int(os.environ.get('downloadworkers', 4)), help='Shards downloaded in parallel')
+
     args = parser.parse_args()
-    
-    main(args.symbol, args.freq)
+
+    main(args.symbol, args.freq, args.sharddays, args.workers)
@@ -0,0 +1,244 @@
+
+import time
+import struct
+
+import numpy as np
+import pandas as pd
+
+import metrics
+
+
+SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+
+# PostgreSQL binary timestamps count microseconds from 2000-01-01
+POSTGRES_EPOCH_US = 946_684_800_000_000
+
+# Column kinds and the NumPy dtype they decode into
+KINDS = {
+    "timestamp": np.int64,  # ns since the Unix epoch
+    "int8": np.int64,
+    "float8": np.float64,
+}
+
+# Raw COPY data collected before decoding it
+FLUSH_BYTES = 64 * 1024
+
+WIRE_TYPES = {
+    "timestamp": ">i8",
+    "int8": ">i8",
+    "float8": ">f8",
+}
+
+
+class BinaryCopySink:
+    """
+    File-like target for COPY ... TO STDOUT WITH BINARY that decodes rows
+    into preallocated NumPy arrays as the data streams in. Raw COPY data
+    is buffered up to `flush_bytes` and then decoded in one go, so only
+    that much is held at a time.
+
+    Every column must be 8 bytes wide (timestamp, int8 or float8). Rows
+    without NULLs are decoded in bulk through a structured dtype; NULLs
+    fall back to a per-row path and decode as NaN (floats) or raise.
+    """
+
+    def __init__(self, kinds, capacity=65536, flush_bytes=FLUSH_BYTES):
+        self.kinds = list(kinds)
+        self.flush_bytes = flush_bytes
+        self.arrays = [np.empty(capacity, dtype=KINDS[kind]) for kind in self.kinds]
+        self.rows = 0
+        self.pending = bytearray()
+        self.in_header = True
+        self.finished = False
+
+        fields = [("fields", ">i2")]
+        for i, kind in enumerate(self.kinds):
+            fields += [(f"length{i}", ">i4"), (f"value{i}", WIRE_TYPES[kind])]
+        self.row_dtype = np.dtype(fields)
+
+    def start_stream(self):
+        # Each COPY statement sends its own header and trailer
+        self.in_header = True
+        self.finished = False
+
+    def _reserve(self, extra):
+        needed = self.rows + extra
+        capacity = len(self.arrays[0])
+        if needed <= capacity:
+            return
+        capacity = max(needed, 2 * capacity)
+        for i, array in enumerate(self.arrays):
+            grown = np.empty(capacity, dtype=array.dtype)
+            grown[:self.rows] = array[:self.rows]
+            self.arrays[i] = grown
+
+    def _read_header(self):
+        if len(self.pending) < len(SIGNATURE) + 8:
+            return False
+        if bytes(self.pending[:len(SIGNATURE)]) != SIGNATURE:
+            raise ValueError("Not a PostgreSQL binary COPY stream")
+        extension_length = struct.unpack_from(">i", self.pending, len(SIGNATURE) + 4)[0]
+        header_length = len(SIGNATURE) + 8 + extension_length
+        if len(self.pending) < header_length:
+            return False
+        del self.pending[:header_length]
+        self.in_header = False
+        return True
+
+    def _store(self, values):
+        for i, (kind, column) in enumerate(zip(self.kinds, values)):
+            if kind == "timestamp":
+                column = (column + POSTGRES_EPOCH_US) * 1000
+            self.arrays[i][self.rows:self.rows + len(column)] = column
+        self.rows += len(values[0])
+
+    def _decode_bulk(self):
+        row_size = self.row_dtype.itemsize
+        count = len(self.pending) // row_size
+        if count == 0:
+            return 0
+
+        rows = np.frombuffer(self.pending, dtype=self.row_dtype, count=count)
+        ok = rows["fields"] == len(self.kinds)
+        for i in range(len(self.kinds)):
+            ok &= rows[f"length{i}"] == 8
+        # Stop at the first row that isn't full width (a NULL or the trailer)
+        good = count if ok.all() else int(np.argmin(ok))
+        if good == 0:
+            return 0
+
+        self._reserve(good)
+        self._store([rows[f"value{i}"][:good] for i in range(len(self.kinds))])
+        del rows
+        del self.pending[:good * row_size]
+        return good
+
+    def _decode_one(self):
+        if len(self.pending) < 2:
+            return False
+        fields = struct.unpack_from(">h", self.pending, 0)[0]
+        if fields == -1:
+            del self.pending[:2]
+            self.finished = True
+            return False
+
+        offset = 2
+        values = []
+        for kind in self.kinds:
+            if len(self.pending) < offset + 4:
+                return False
+            length = struct.unpack_from(">i", self.pending, offset)[0]
+            offset += 4
+            if length == -1:
+                if kind != "float8":
+                    raise ValueError(f"NULL in non-float column ({kind})")
+                values.append(np.nan)
+                continue
+            if len(self.pending) < offset + length:
+                return False
+            values.append(np.frombuffer(self.pending, dtype=WIRE_TYPES[kind], count=1, offset=offset)[0])
+            offset += length
+
+        self._reserve(1)
+        self._store([np.array([value], dtype=KINDS[kind]) for value, kind in zip(values, self.kinds)])
+        del self.pending[:offset]
+        return True
+
+    def write(self, data):
+        # copy_expert writes one CopyData message, i.e. one row, at a time; decoding
+        # every call would run the bulk path row by row, so wait for a full buffer
+        self.pending += data
+        if len(self.pending) >= self.flush_bytes:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        """
+        Decode whatever complete rows are buffered. copy_columns calls it
+        once the COPY is done to pick up the rest and the trailer.
+        """
+        if self.in_header and not self._read_header():
+            return
+
+        while not self.finished:
+            if self._decode_bulk():
+                continue
+            if not self._decode_one():
+                break
+
+    def result(self):
+        return [array[:self.rows] for array in self.arrays]
+
+
+def copy_columns(connection, query, params, kinds, capacity=65536, sink=None, table="query"):
+    """
+    Run `query` (psycopg2 %(name)s placeholders) through
+    COPY (...) TO STDOUT WITH BINARY and return its columns as NumPy
+    arrays. `kinds` lists each selected column's kind ("timestamp",
+    "int8" or "float8"). Timestamps come back as int64 nanoseconds since
+    the Unix epoch, assuming naive UTC columns.
+
+    Pass a `sink` to append several queries into the same arrays.
+    `table` only labels the transfer in the metrics.
+    """
+    sink = sink or BinaryCopySink(kinds, capacity)
+    sink.start_stream()
+    rows_before = sink.rows
+    began = time.perf_counter()
+
+    cursor = connection.connection.cursor()
+    try:
+        statement = cursor.mogrify(query, params).decode()
+        cursor.copy_expert(f"COPY ({statement}) TO STDOUT WITH BINARY", sink)
+    finally:
+        cursor.close()
+    sink.flush()
+
+    if sink.pending or not sink.finished:
+        raise ValueError("Truncated binary COPY stream")
+
+    metrics.db_copy_seconds.observe(time.perf_counter() - began, table=table, direction="out")
+    metrics.db_copy_rows.inc(sink.rows - rows_before, table=table, direction="out")
+    return sink.result()
+
+
+def read_prices(connection, table, symbol, start=None, end=None, columns=("open", "close"), chunk=None, capacity=65536):
+    """
+    Timestamps and `columns` of `symbol` in [start, end) from `table`, in
+    timestamp order, as a dict of NumPy arrays. With `chunk` (a
+    Timedelta), the range is read as several COPY statements of at most
+    that length.
+    """
+    kinds = ["timestamp"] + ["float8"] * len(columns)
+    sink = BinaryCopySink(kinds, capacity)
+    select = ", ".join(["timestamp"] + [f"{column}::float8" for column in columns])
+
+    def read(range_start, range_end):
+        conditions = ["symbol = %(symbol)s"]
+        params = {"symbol": symbol}
+        if range_start is not None:
+            conditions.append("timestamp >= %(start)s")
+            params["start"] = _naive_utc(range_start)
+        if range_end is not None:
+            conditions.append("timestamp < %(end)s")
+            params["end"] = _naive_utc(range_end)
+        query = f"SELECT {select} FROM {table} WHERE {' AND '.join(conditions)} ORDER BY timestamp"
+        copy_columns(connection, query, params, kinds, sink=sink, table=table)
+
+    if chunk is None or start is None or end is None:
+        read(start, end)
+    else:
+        range_start = pd.Timestamp(start)
+        while range_start < pd.Timestamp(end):
+            range_end = min(range_start + chunk, pd.Timestamp(end))
+            read(range_start, range_end)
+            range_start = range_end
+
+    return dict(zip(["timestamp"] + list(columns), sink.result()))
+
+
+def _naive_utc(timestamp):
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert("UTC").tz_localize(None)
+    return timestamp.to_pydatetime()
@@ -1,53 +1,143 @@
-
 import os
 import pytz
 import telebot
 import logging
 import datetime
 
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+
+from db import get_engine
 
-from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from rate_limit import WeightBudget, with_retries
+
+
+# Telegram lets a bot post about 20 messages per minute to one group
+MESSAGES_PER_MINUTE = 20
 
 
 def send_message(bot, message):
     bot.send_message(chat_id="@NGUSTRAT", text=message)
 
+
+def ensure_announced_transitions(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS announced_transitions (
+            bot_name VARCHAR NOT NULL,
+            timestamp TIMESTAMP NOT NULL,
+            position BOOLEAN NOT NULL,
+            announced_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+            PRIMARY KEY (bot_name, timestamp)
+        )
+        """))
+
+
+def get_transitions(connection, start_timestamp, lookback):
+    """
+    Position changes of every bot at or after `start_timestamp` that were
+    not announced yet, oldest first. Rows from `lookback` before the
+    window give LAG the position each bot held when the window opened.
+    The range predicates use the bots primary key, which leads with
+    timestamp.
+    """
+    result = connection.execute(text("""
+        SELECT positions.bot_name, positions.timestamp, positions.position
+        FROM (
+            SELECT bot_name, timestamp, position,
+                   LAG(position) OVER (PARTITION BY bot_name ORDER BY timestamp) AS previous_position
+            FROM bots
+            WHERE timestamp >= :lookback_start
+        ) AS positions
+        WHERE positions.timestamp >= :start_timestamp
+          AND positions.position <> positions.previous_position
+          AND NOT EXISTS (
+              SELECT 1 FROM announced_transitions AS announced
+              WHERE announced.bot_name = positions.bot_name
+                AND announced.timestamp = positions.timestamp
+          )
+        ORDER BY positions.timestamp, positions.bot_name
+        """), {"start_timestamp": start_timestamp, "lookback_start": start_timestamp - lookback})
+    return result.fetchall()
+
+
+def claim_transition(connection, transition):
+    """
+    Record a transition as announced. Returns False when another run
+    already claimed it, so each transition is sent at most once.
+    """
+    result = connection.execute(text("""
+        INSERT INTO announced_transitions (bot_name, timestamp, position)
+        VALUES (:bot_name, :timestamp, :position)
+        ON CONFLICT (bot_name, timestamp) DO NOTHING
+        RETURNING bot_name
+        """), {"bot_name": transition.bot_name, "timestamp": transition.timestamp, "position": transition.position})
+    return result.first() is not None
+
+
+def release_transition(connection, transition):
+    connection.execute(
+        text("DELETE FROM announced_transitions WHERE bot_name = :bot_name AND timestamp = :timestamp"),
+        {"bot_name": transition.bot_name, "timestamp": transition.timestamp},
+    )
+
+
 def ping_telegram():
 
-    load_dotenv()
-    database_password = os.environ.get('password')
-    server_address = os.environ.get('serverip')
-    telegramtoken = os.environ.get('telegramtoken')
-    logging.info(f"Loaded dotenv values.")
-    connection_string = f"postgresql://postgres:{database_password}@{server_address}:5432/postgres"
     global engine
-    engine = create_engine(connection_string)
+    engine = get_engine()
+    telegramtoken = os.environ.get('telegramtoken')
+    window_hours = float(os.environ.get('telegramwindowhours', 2))
+    telegram_workers = int(os.environ.get('telegramworkers', 4))
     logging.info(f"Connected to database.")
     bot = telebot.TeleBot(telegramtoken)
 
-    end_timestamp = datetime.datetime.now(pytz.utc)
-    start_timestamp = end_timestamp - datetime.timedelta(hours=2)
-
-    sql_query = text("""
-        SELECT *
-        FROM bots
-        WHERE timestamp >= :start_timestamp;
-        """)
+    # Bots table timestamps are naive UTC
+    end_timestamp = datetime.datetime.now(pytz.utc).replace(tzinfo=None)
+    start_timestamp = end_timestamp - datetime.timedelta(hours=window_hours)
 
     with engine.begin() as connection:
-        result = connection.execute(sql_query, {"start_timestamp": start_timestamp})
+        ensure_announced_transitions(connection)
+        transitions = get_transitions(connection, start_timestamp, datetime.timedelta(days=1))
+        # Claims commit before sending, a concurrent run skips what this one is announcing
+        transitions = [transition for transition in transitions if claim_transition(connection, transition)]
 
-    result = pd.DataFrame(result.fetchall())
+    logging.info(f"{len(transitions)} position changes to announce.")
 
+    budget = WeightBudget(MESSAGES_PER_MINUTE)
 
-    for i in result["bot_name"].unique():
-        last_positions = result[result["bot_name"]==i]["position"]
-        if last_positions.iloc[1] != last_positions.iloc[0]:
-            if last_positions.iloc[1]:
-                msg = f"{i} just bought!"
-            else:
-                msg = f"{i} just sold!"
+    def announce(transition):
+        if transition.position:
+            msg = f"{transition.bot_name} just bought!"
+        else:
+            msg = f"{transition.bot_name} just sold!"
+
+        def send():
+            budget.acquire(1)
             send_message(bot, msg)
 
+        with_retries(send, attempts=3, base_delay=2.0, description=f"Announcing {transition.bot_name}")
+
+    def announce_bot(bot_transitions):
+        # One bot's transitions go out in order, after a failure the rest wait for the next run
+        for i, transition in enumerate(bot_transitions):
+            try:
+                announce(transition)
+            except Exception as e:
+                logging.error(f"Could not announce {transition.bot_name} at {transition.timestamp}: {e}")
+                return bot_transitions[i:]
+        return []
+
+    # Bots are announced concurrently, each one's buys and sells serially
+    by_bot = {}
+    for transition in transitions:
+        by_bot.setdefault(transition.bot_name, []).append(transition)
+
+    with ThreadPoolExecutor(max_workers=telegram_workers) as executor:
+        failed = [transition for unsent in executor.map(announce_bot, by_bot.values()) for transition in unsent]
+
+    # Unsent transitions are released so the next run retries them
+    if failed:
+        with engine.begin() as connection:
+            for transition in failed:
+                release_transition(connection, transition)
@@ -0,0 +1,176 @@
+
+import os
+import json
+import shutil
+import logging
+
+import numpy as np
+import pandas as pd
+
+from sqlalchemy import text
+
+import metrics
+from pg_binary import copy_columns
+
+
+COLUMNS = {
+    "timestamp": np.int64,
+    "open": np.float64,
+    "close": np.float64,
+}
+
+# Per-row hash summed server-side; sums combine, so appended ranges extend the fingerprint
+ROW_HASH = "hashtextextended(timestamp::text || ',' || open::text || ',' || close::text, 0)"
+
+
+class PriceCache:
+    """
+    On-disk columnar cache of one rollup table: a raw array file per
+    column and symbol, opened with np.memmap, plus a small meta.json.
+
+    Only rows older than the newest one in the database are cached, since
+    the newest bucket is still being filled. Every sync checks the cached
+    range against a server-side fingerprint and drops the symbol's cache
+    when upstream rows changed, then appends the rows since the cached
+    watermark.
+    """
+
+    def __init__(self, directory, interval="1h"):
+        self.directory = os.path.join(directory, interval)
+        self.table = f"market_data_{interval}"
+
+    def _symbol_dir(self, symbol):
+        return os.path.join(self.directory, symbol)
+
+    def _path(self, symbol, name):
+        return os.path.join(self._symbol_dir(symbol), name)
+
+    def meta(self, symbol):
+        try:
+            with open(self._path(symbol, "meta.json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_meta(self, symbol, meta):
+        path = self._path(symbol, "meta.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def arrays(self, symbol):
+        """
+        Memory-mapped, read-only column arrays of the cached rows.
+        """
+        meta = self.meta(symbol)
+        if meta is None or meta["rows"] == 0:
+            return {column: np.empty(0, dtype=dtype) for column, dtype in COLUMNS.items()}
+        return {
+            column: np.memmap(self._path(symbol, f"{column}.bin"), dtype=dtype, mode="r", shape=(meta["rows"],))
+            for column, dtype in COLUMNS.items()
+        }
+
+    def invalidate(self, symbol):
+        shutil.rmtree(self._symbol_dir(symbol), ignore_errors=True)
+
+    def append(self, symbol, columns, fingerprint):
+        """
+        Append rows (a dict of equally long arrays, newer than the cached
+        ones) and add their summed row hashes to the fingerprint.
+        """
+        os.makedirs(self._symbol_dir(symbol), exist_ok=True)
+        meta = self.meta(symbol) or {"rows": 0, "last": None, "fingerprint": 0}
+        rows = len(columns["timestamp"])
+        if rows == 0:
+            return meta
+
+        for column, dtype in COLUMNS.items():
+            path = self._path(symbol, f"{column}.bin")
+            with open(path, "ab") as f:
+                # Drop bytes left behind by an append that crashed before its meta update
+                f.truncate(meta["rows"] * np.dtype(dtype).itemsize)
+                np.ascontiguousarray(columns[column], dtype=dtype).tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+
+        meta = {
+            "rows": meta["rows"] + rows,
+            "last": int(columns["timestamp"][-1]),
+            "fingerprint": meta["fingerprint"] + fingerprint,
+        }
+        self._write_meta(symbol, meta)
+        return meta
+
+    def sync(self, connection, symbol, begin=None):
+        """
+        Bring the cache of `symbol` up to date and return its rows from
+        `begin` on as a list of column dicts in time order: memory-mapped
+        views of the cached rows, found by binary search, followed by the
+        newest rows, which are read from the database but not cached.
+        Nothing is copied, callers that need one array join the parts.
+        """
+        meta = self.meta(symbol)
+        last = None
+
+        if meta is not None and meta["rows"]:
+            last = pd.Timestamp(meta["last"], unit="ns").to_pydatetime()
+            result = connection.execute(text(f"""
+                SELECT COUNT(*) AS rows, COALESCE(SUM({ROW_HASH}::numeric), 0) AS fingerprint
+                FROM {self.table}
+                WHERE symbol = :symbol AND timestamp <= :last
+                """), {"symbol": symbol, "last": last})
+            row = result.one()
+            if row.rows != meta["rows"] or int(row.fingerprint) != meta["fingerprint"]:
+                logging.info(f"Upstream rows of {symbol} changed, dropping its {self.table} cache.")
+                metrics.price_cache_invalidations.inc()
+                self.invalidate(symbol)
+                last = None
+
+        params = {"symbol": symbol}
+        after = ""
+        if last is not None:
+            after = "AND timestamp > %(last)s"
+            params["last"] = last
+
+        timestamps, opens, closes, row_hashes = copy_columns(
+            connection,
+            f"""
+            SELECT timestamp, open::float8, close::float8, {ROW_HASH}
+            FROM {self.table}
+            WHERE symbol = %(symbol)s {after}
+            ORDER BY timestamp
+            """,
+            params,
+            ["timestamp", "float8", "float8", "int8"],
+            table=self.table,
+        )
+        delta_columns = {"timestamp": timestamps, "open": opens, "close": closes}
+
+        if len(timestamps) > 1:
+            self.append(
+                symbol,
+                {column: values[:-1] for column, values in delta_columns.items()},
+                sum(int(h) for h in row_hashes[:-1]),
+            )
+            cached = self.arrays(symbol)
+            tail = {column: values[-1:] for column, values in delta_columns.items()}
+        else:
+            cached = self.arrays(symbol)
+            tail = delta_columns
+
+        if begin is not None:
+            begin = pd.Timestamp(begin).value
+            start = int(np.searchsorted(cached["timestamp"], begin, side="left"))
+            cached = {column: values[start:] for column, values in cached.items()}
+            keep = tail["timestamp"] >= begin
+            tail = {column: values[keep] for column, values in tail.items()}
+
+        # Rows just appended are served from the cache from the next sync on
+        fresh = min(max(len(timestamps) - 1, 0), len(cached["timestamp"]))
+        metrics.price_cache_rows.inc(len(cached["timestamp"]) - fresh, source="cache")
+        metrics.price_cache_rows.inc(len(timestamps), source="database")
+        logging.info(f"{symbol}: {len(cached['timestamp'])} cached rows, {len(timestamps)} read from {self.table}")
+
+        return [cached, tail]
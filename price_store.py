@@ -0,0 +1,147 @@
+
+import logging
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import metrics
+
+
+class _Series:
+    """
+    One symbol's rows: int64 epoch-nanosecond timestamps plus a single
+    (columns, rows) block of values, both sized to exactly the rows
+    written.
+    """
+
+    def __init__(self, parts, columns, dtype):
+        rows = sum(len(part["timestamp"]) for part in parts)
+        self.timestamps = np.empty(rows, dtype=np.int64)
+        self.values = np.empty((len(columns), rows), dtype=dtype)
+
+        # Parts are copied straight into place, never joined first
+        at = 0
+        for part in parts:
+            end = at + len(part["timestamp"])
+            self.timestamps[at:end] = part["timestamp"]
+            for row, column in enumerate(columns):
+                self.values[row, at:end] = part[column]
+            at = end
+
+        self.timestamps.flags.writeable = False
+        self.values.flags.writeable = False
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @property
+    def nbytes(self):
+        return self.timestamps.nbytes + self.values.nbytes
+
+
+class PriceStore:
+    """
+    run_bots' in-memory price history: per symbol, int64 epoch-nanosecond
+    timestamps plus one `dtype` block holding every column (float64, or
+    float32 to halve the footprint). Time ranges are sliced with binary
+    search and handed out as views, frame() included.
+
+    Every symbol counts its buffers against `max_bytes`. When a write
+    goes over, the least recently used other symbols are dropped, to be
+    read again from the database if they are needed later.
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, columns=("open", "close"), dtype=np.float64):
+        self.max_bytes = max_bytes
+        self.columns = tuple(columns)
+        self.dtype = np.dtype(dtype)
+        self.series = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+
+    def __contains__(self, symbol):
+        return symbol in self.series
+
+    def _touch(self, symbol):
+        series = self.series[symbol]
+        self.series.move_to_end(symbol)
+        return series
+
+    def put(self, symbol, parts):
+        """
+        Store the rows of `symbol`, replacing any held before. `parts` is a
+        list of column dicts ("timestamp" as sorted int64 epoch ns plus
+        every column) in time order, such as PriceCache.sync returns.
+        """
+        self.drop(symbol)
+        series = self.series[symbol] = _Series(parts, self.columns, self.dtype)
+        self.bytes += series.nbytes
+        self._evict(keep=symbol)
+
+    def _evict(self, keep):
+        while self.bytes > self.max_bytes:
+            victim = next((symbol for symbol in self.series if symbol != keep), None)
+            if victim is None:
+                logging.warning(f"Price store: {keep} alone needs {self.bytes / 1024 / 1024:.1f} MB, over the budget")
+                return
+            self.drop(victim)
+            self.evictions += 1
+            metrics.price_store_evictions.inc()
+
+    def drop(self, symbol):
+        series = self.series.pop(symbol, None)
+        if series is not None:
+            self.bytes -= series.nbytes
+
+    def first(self, symbol):
+        """
+        UTC timestamp of the oldest stored row of `symbol`, None without rows.
+        """
+        series = self.series.get(symbol)
+        if series is None or not len(series):
+            return None
+        return pd.Timestamp(int(series.timestamps[0]), unit="ns", tz="UTC")
+
+    def _bounds(self, series, start, end):
+        lo = 0 if start is None else int(np.searchsorted(series.timestamps, _epoch_ns(start), side="left"))
+        hi = len(series) if end is None else int(np.searchsorted(series.timestamps, _epoch_ns(end), side="left"))
+        return lo, hi
+
+    def slice(self, symbol, start=None, end=None):
+        """
+        Rows of `symbol` in [start, end) as a dict of read-only array views
+        ("timestamp" plus every column), found by binary search.
+        """
+        series = self._touch(symbol)
+        lo, hi = self._bounds(series, start, end)
+        views = {"timestamp": series.timestamps[lo:hi]}
+        for row, column in enumerate(self.columns):
+            views[column] = series.values[row, lo:hi]
+        return views
+
+    def frame(self, symbol, start=None, end=None):
+        """
+        slice() as a read-only DataFrame on a UTC DatetimeIndex, as
+        load_symbol_data used to return. The frame's one block is a view
+        of the stored values, only its UTC index is built anew.
+        """
+        series = self._touch(symbol)
+        lo, hi = self._bounds(series, start, end)
+        index = pd.DatetimeIndex(series.timestamps[lo:hi].view("datetime64[ns]")).tz_localize("UTC")
+        return pd.DataFrame(series.values[:, lo:hi].T, index=index, columns=list(self.columns), copy=False)
+
+    def log_stats(self):
+        rows = sum(len(series) for series in self.series.values())
+        logging.info(
+            f"Price store: {len(self.series)} symbols, {rows} rows using {self.bytes / 1024 / 1024:.1f} MB "
+            f"of {self.max_bytes / 1024 / 1024:.0f} MB, {self.evictions} evictions"
+        )
+
+
+def _epoch_ns(timestamp):
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize("UTC")
+    return timestamp.value
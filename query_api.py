@@ -0,0 +1,340 @@
+
+import re
+import json
+import time
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from sqlalchemy import text
+
+import metrics
+from pg_binary import copy_columns
+from market_data_rollup import rollup_table
+
+
+# Aligns every bucket: midnight, and a Monday for weekly buckets like Binance's
+BUCKET_ORIGIN = "2017-01-02"
+
+UNIT_MINUTES = {"m": 1, "h": 60, "d": 1440, "w": 10080}
+
+# Bars returned when `start` is left out, and the most one response may hold
+DEFAULT_BARS = 1000
+MAX_BARS = 50_000
+
+# Widest bucket, four weeks
+MAX_INTERVAL_MINUTES = 4 * 10080
+
+OHLCV_COLUMNS = ("open", "high", "low", "close", "volume")
+
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+
+
+class QueryError(Exception):
+    pass
+
+
+class ResponseCache:
+    """
+    LRU of rendered responses, each tagged with the data version it was
+    built from. An entry is served while its version is current and it
+    is younger than `ttl` seconds. Versions (ingestion watermarks, newest
+    bot rows) are themselves looked up at most every `version_ttl`
+    seconds, and concurrent misses on one key wait for a single build, so
+    any number of readers cost about one query per data change.
+
+    Bounded by the total size of the cached bodies rather than by entry
+    count, since one body ranges from a few bars to MAX_BARS.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=300, version_ttl=5, max_versions=4096):
+        self.max_bytes = max_bytes
+        self.max_versions = max_versions
+        self.bytes = 0
+        self.ttl = ttl
+        self.version_ttl = version_ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # Keyed by whatever symbol or bot requests name, so bounded too
+        self.versions = OrderedDict()
+        self.building = {}
+
+    def version(self, key, lookup):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.versions.get(key)
+            if cached is not None and now - cached[1] < self.version_ttl:
+                self.versions.move_to_end(key)
+                return cached[0]
+        value = lookup()
+        with self.lock:
+            self.versions[key] = (value, now)
+            self.versions.move_to_end(key)
+            while len(self.versions) > self.max_versions:
+                self.versions.popitem(last=False)
+        return value
+
+    def get(self, key, version, build):
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] == version and time.monotonic() - entry[1] < self.ttl:
+                    self.entries.move_to_end(key)
+                    metrics.query_cache_lookups.inc(result="hit")
+                    return entry[2]
+
+                pending = self.building.get(key)
+                if pending is None:
+                    pending = self.building[key] = threading.Event()
+                    break
+            # Another request is building this response, use its result
+            pending.wait()
+
+        metrics.query_cache_lookups.inc(result="miss")
+        try:
+            value = build()
+            nbytes = len(value[0])
+            with self.lock:
+                if key in self.entries:
+                    self.bytes -= self.entries.pop(key)[3]
+                # A body larger than the whole budget is not worth caching
+                if nbytes <= self.max_bytes:
+                    self.entries[key] = (version, time.monotonic(), value, nbytes)
+                    self.bytes += nbytes
+                while self.bytes > self.max_bytes:
+                    _, (_, _, _, evicted_bytes) = self.entries.popitem(last=False)
+                    self.bytes -= evicted_bytes
+            return value
+        finally:
+            with self.lock:
+                del self.building[key]
+            pending.set()
+
+
+def parse_interval(interval):
+    """
+    Bucket size in minutes of an interval like "15m", "4h", "1d" or "1w".
+    """
+    match = re.fullmatch(r"(\d+)([mhdw])", interval or "")
+    if match is None or int(match.group(1)) == 0:
+        raise QueryError(f"Invalid interval {interval!r}, expected e.g. 1m, 15m, 4h, 1d or 1w")
+    minutes = int(match.group(1)) * UNIT_MINUTES[match.group(2)]
+    if minutes > MAX_INTERVAL_MINUTES:
+        raise QueryError(f"Interval {interval!r} is longer than the 4w maximum")
+    return minutes
+
+
+def parse_time(value, name):
+    if value in (None, ""):
+        return None
+    try:
+        # Epoch milliseconds, as in the responses, or anything pandas parses
+        timestamp = pd.Timestamp(int(value), unit="ms") if value.lstrip("-").isdigit() else pd.Timestamp(value)
+        # Nanoseconds, as everything downstream, which bounds it to 1677-2262
+        timestamp = timestamp.as_unit("ns")
+    except (ValueError, OverflowError):
+        raise QueryError(f"Invalid {name} {value!r}")
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert("UTC").tz_localize(None)
+    return timestamp
+
+
+def source_for(minutes):
+    """
+    Smallest stored series every `minutes` bucket can be built from, as
+    (table, minutes per row, extra filter).
+    """
+    if minutes % 1440 == 0:
+        return rollup_table("1d"), 1440, ""
+    if minutes % 60 == 0:
+        return rollup_table("1h"), 60, ""
+    return "market_data", 1, "AND interval = '1m'"
+
+
+def read_ohlcv(connection, symbol, minutes, start, end):
+    """
+    `symbol` candles of `minutes` in [start, end), aggregated in the
+    database from the coarsest table that divides them. Returns a dict of
+    NumPy arrays (timestamps as int64 ns).
+    """
+    table, source_minutes, interval_filter = source_for(minutes)
+
+    conditions = f"symbol = %(symbol)s {interval_filter} AND timestamp >= %(start)s"
+    params = {"symbol": symbol, "start": start.to_pydatetime()}
+    if end is not None:
+        conditions += " AND timestamp < %(end)s"
+        params["end"] = end.to_pydatetime()
+
+    if minutes == source_minutes:
+        query = f"""
+            SELECT timestamp, open::float8, high::float8, low::float8, close::float8, volume::float8
+            FROM {table}
+            WHERE {conditions}
+            ORDER BY timestamp
+            """
+    else:
+        # Same bucketing as date_bin, which needs PostgreSQL 14
+        params["seconds"] = minutes * 60
+        bucket = (
+            f"TIMESTAMP '{BUCKET_ORIGIN}' + floor(extract(epoch FROM timestamp - TIMESTAMP '{BUCKET_ORIGIN}') "
+            f"/ %(seconds)s) * %(seconds)s * INTERVAL '1 second'"
+        )
+        query = f"""
+            SELECT
+                {bucket} AS bucket,
+                ((array_agg(open ORDER BY timestamp))[1])::float8,
+                MAX(high)::float8,
+                MIN(low)::float8,
+                ((array_agg(close ORDER BY timestamp DESC))[1])::float8,
+                SUM(volume)::float8
+            FROM {table}
+            WHERE {conditions}
+            GROUP BY bucket
+            ORDER BY bucket
+            """
+
+    columns = copy_columns(connection, query, params, ["timestamp"] + ["float8"] * 5, table=table)
+    return dict(zip(("timestamp",) + OHLCV_COLUMNS, columns))
+
+
+def read_positions(connection, bot, start, end, changes_only):
+    conditions = "bot_name = %(bot)s"
+    params = {"bot": bot}
+    if start is not None:
+        conditions += " AND timestamp >= %(start)s"
+        params["start"] = start.to_pydatetime()
+    if end is not None:
+        conditions += " AND timestamp < %(end)s"
+        params["end"] = end.to_pydatetime()
+
+    query = f"SELECT timestamp, position::int::int8 AS position FROM bots WHERE {conditions} ORDER BY timestamp"
+    if changes_only:
+        # Only the rows where the position flips, plus the first one
+        query = f"""
+            SELECT timestamp, position FROM (
+                SELECT timestamp, position, LAG(position) OVER (ORDER BY timestamp) AS previous
+                FROM ({query}) AS rows
+            ) AS flips
+            WHERE previous IS DISTINCT FROM position
+            ORDER BY timestamp
+            """
+
+    timestamps, positions = copy_columns(connection, query, params, ["timestamp", "int8"], table="bots")
+    return {"timestamp": timestamps, "position": positions.astype(bool)}
+
+
+def render(columns, fmt, meta):
+    """
+    Columnar response body: JSON with epoch millisecond timestamps, or an
+    Arrow IPC stream (needs pyarrow). Returns (body, mimetype).
+    """
+    if fmt == "arrow":
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise QueryError("format=arrow needs pyarrow installed on the server")
+        arrays = {
+            name: pa.array(values.astype("datetime64[ns]"), pa.timestamp("ns", tz="UTC")) if name == "timestamp" else pa.array(values)
+            for name, values in columns.items()
+        }
+        batch = pa.RecordBatch.from_pydict(arrays, metadata={key: str(value) for key, value in meta.items()})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, batch.schema) as writer:
+            writer.write_batch(batch)
+        return sink.getvalue().to_pybytes(), ARROW_MIMETYPE
+
+    if fmt != "json":
+        raise QueryError(f"Unknown format {fmt!r}, expected json or arrow")
+
+    body = {}
+    for name, values in columns.items():
+        if name == "timestamp":
+            body[name] = (values // 1_000_000).tolist()
+        elif values.dtype.kind == "f" and np.isnan(values).any():
+            body[name] = [None if np.isnan(value) else value for value in values.tolist()]
+        else:
+            body[name] = values.tolist()
+    return json.dumps({**meta, "columns": body}, separators=(",", ":")).encode(), "application/json"
+
+
+def symbol_watermark(engine, symbol):
+    with engine.connect() as connection:
+        result = connection.execute(
+            text("SELECT last_timestamp FROM ingest_watermarks WHERE symbol = :symbol AND interval = '1m'"),
+            {"symbol": symbol},
+        )
+        return result.scalar()
+
+
+def bot_watermark(engine, bot):
+    # Index-only descent of ix_bots_bot_name_timestamp
+    with engine.connect() as connection:
+        result = connection.execute(text("SELECT MAX(timestamp) FROM bots WHERE bot_name = :bot"), {"bot": bot})
+        return result.scalar()
+
+
+def ohlcv_response(engine, cache, args):
+    """
+    (body, mimetype) of /ohlcv?symbol=&interval=&start=&end=&format=.
+    Without `start`, the last DEFAULT_BARS buckets before `end` (or now).
+    """
+    symbol = args.get("symbol")
+    if not symbol:
+        raise QueryError("symbol is required")
+    interval = args.get("interval", "1h")
+    minutes = parse_interval(interval)
+    start = parse_time(args.get("start"), "start")
+    end = parse_time(args.get("end"), "end")
+    fmt = args.get("format", "json")
+
+    step = pd.Timedelta(minutes=minutes)
+    try:
+        if start is None:
+            # On the bucket grid, so every reader of the latest bars shares one cache key per bucket
+            latest = end if end is not None else pd.Timestamp.now(tz="UTC").tz_localize(None)
+            origin = pd.Timestamp(BUCKET_ORIGIN)
+            start = origin + ((latest - origin) // step) * step - step * (DEFAULT_BARS - 1)
+        span = (end if end is not None else pd.Timestamp.now(tz="UTC").tz_localize(None)) - start
+    except (ValueError, OverflowError):
+        # Out of bounds timestamps and timedeltas are ValueErrors
+        raise QueryError("Requested time range is out of bounds")
+    if end is not None and end <= start:
+        raise QueryError("end must be after start")
+    if span / step > MAX_BARS:
+        raise QueryError(f"More than {MAX_BARS} {interval} bars requested, narrow the range or use a larger interval")
+
+    version = cache.version(("symbol", symbol), lambda: symbol_watermark(engine, symbol))
+    key = ("ohlcv", symbol, minutes, start, end, fmt)
+
+    def build():
+        with engine.connect() as connection:
+            columns = read_ohlcv(connection, symbol, minutes, start, end)
+        return render(columns, fmt, {"symbol": symbol, "interval": interval})
+
+    return cache.get(key, version, build)
+
+
+def positions_response(engine, cache, args):
+    """
+    (body, mimetype) of /positions?bot=&start=&end=&changes=&format=.
+    """
+    bot = args.get("bot")
+    if not bot:
+        raise QueryError("bot is required")
+    start = parse_time(args.get("start"), "start")
+    end = parse_time(args.get("end"), "end")
+    changes_only = args.get("changes", "").lower() in ("1", "true", "yes")
+    fmt = args.get("format", "json")
+
+    version = cache.version(("bot", bot), lambda: bot_watermark(engine, bot))
+    key = ("positions", bot, start, end, changes_only, fmt)
+
+    def build():
+        with engine.connect() as connection:
+            columns = read_positions(connection, bot, start, end, changes_only)
+        return render(columns, fmt, {"bot": bot})
+
+    return cache.get(key, version, build)
@@ -0,0 +1,37 @@
+
+import hashlib
+
+import numpy as np
+
+from hourly_resample import HOUR_NS, epoch_ns
+
+
+def stable_key(symbol, seed):
+    """
+    128-bit Philox key derived from the symbol and seed. Unlike hash(),
+    it doesn't depend on PYTHONHASHSEED, so it is the same in every
+    process.
+    """
+    digest = hashlib.blake2b(f"{symbol}:{seed}".encode(), digest_size=16).digest()
+    return np.frombuffer(digest, dtype="<u8").copy()
+
+
+def random_positions(index, symbol, seed, bucket_ns=HOUR_NS):
+    """
+    Reproducible True/False position per bar of a UTC DatetimeIndex.
+
+    Counter-based: the bar starting at hour h always gets the first output
+    word of Philox block h + 1 under the (symbol, seed) key, so a bar's
+    value doesn't depend on which range is generated or on the process.
+    """
+    if len(index) == 0:
+        return np.empty(0, dtype=bool)
+
+    buckets = epoch_ns(index) // bucket_ns
+    first = int(buckets.min())
+    span = int(buckets.max()) - first + 1
+
+    bit_generator = np.random.Philox(key=stable_key(symbol, seed), counter=first)
+    words = bit_generator.random_raw(4 * span)[::4]
+
+    return (words[buckets - first] & 1).astype(bool)
@@ -0,0 +1,54 @@
+
+import time
+import random
+import logging
+import threading
+
+
+class WeightBudget:
+    """
+    Thread-safe token bucket of request weight per minute. Every request
+    acquires its weight before it is sent, so concurrent workers together
+    stay under the limit.
+    """
+
+    def __init__(self, weight_per_minute):
+        self.capacity = float(weight_per_minute)
+        self.available = self.capacity
+        self.refill_rate = self.capacity / 60.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.refill_rate)
+        self.updated = now
+
+    def acquire(self, weight):
+        # Requests heavier than the whole bucket wait for a full bucket
+        weight = min(float(weight), self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.available >= weight:
+                    self.available -= weight
+                    return
+                wait = (weight - self.available) / self.refill_rate
+            time.sleep(wait)
+
+
+def with_retries(func, attempts=4, base_delay=1.0, max_delay=30.0, description=""):
+    """
+    Call `func` until it succeeds, sleeping with exponential backoff and
+    jitter between attempts. Returns (result, attempts_used).
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return func(), attempt
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+            delay = delay * (0.5 + random.random())
+            logging.warning(f"{description} failed (attempt {attempt}/{attempts}): {e}. Retrying in {delay:.1f}s")
+            time.sleep(delay)
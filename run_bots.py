@@ -1,59 +1,38 @@
 
 import os
-import json
 import pytz
-import random
-import requests
 
 import pandas as pd
-import pandas_ta as ta
 
-from dotenv import load_dotenv
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+
+from db import get_engine
+from bulk_write import copy_frame
+from zlema_engine import ZlemaEngine
+from indicator_cache import IndicatorCache
+from hourly_resample import resample_hourly
+from bot_executor import evaluate_parallel, evaluate_symbol
+from price_cache import PriceCache
+from price_store import PriceStore
+from bots_config import DEFAULT_URL, load_bots_config
+from pg_binary import read_prices
+
 
 def run_bots():
     
     def resample_1h(data):
-        all_dates = pd.date_range(start=data.index.min(), end=data.index.max(), freq="1T")
-        data = data.reindex(all_dates, method='ffill')
-
-        hourly_bt_data = data.resample("1H").agg({"open": "first", "close": "last"})
-        hourly_bt_data = hourly_bt_data.dropna()
-        return hourly_bt_data
-
-
-
-    def get_zzurfer_bots_data(bot, data):
-        zurfer_bot_1 = {
-            "first_zlema_period":bot["first_zlema_period"],
-            "second_zlema_period":bot["second_zlema_period"],
-            "condition":bot["condition"],
-        }
-        zurfer_1 = get_zurfer_bots_data(zurfer_bot_1, data)
-
-        zurfer_bot_2 = {
-            "first_zlema_period":bot["first_zlema_period_2"],
-            "second_zlema_period":bot["second_zlema_period_2"],
-            "condition":bot["condition_2"],
-        }
-        zurfer_2 = get_zurfer_bots_data(zurfer_bot_2, data)
-
-        zzurfer = pd.DataFrame()
-
-        zzurfer["position"] = zurfer_1["position"] | zurfer_2["position"]
-
-        return zzurfer.dropna()
+        return resample_hourly(data)
 
     def get_zzurfer_begin_date(zzurfer_bot):
         # Check the database for the most recent timestamp
         most_recent_timestamp = get_bot_max_timestamp(zzurfer_bot)
 
-        zlema_lookback = 4*max(
+        zlema_periods = [
             zzurfer_bot["first_zlema_period"],
             zzurfer_bot["second_zlema_period"],
             zzurfer_bot["first_zlema_period_2"],
-            zzurfer_bot["second_zlema_period_2"])
+            zzurfer_bot["second_zlema_period_2"]]
 
         # Calculate actual_begin_date based on strategy lookback
         if most_recent_timestamp is not None:
@@ -66,67 +45,30 @@ def run_bots():
                 return None, None
             
             print(f"Bot {zzurfer_bot['bot_name']} is not up to date")
-            actual_begin_date = most_recent_timestamp - pd.Timedelta(hours=zlema_lookback)
 
-        else:
-            actual_begin_date = pd.Timestamp("2017-01-01")
+        actual_begin_date = get_zlema_begin_date(zzurfer_bot["symbol"], zlema_periods, most_recent_timestamp)
         
         return actual_begin_date, most_recent_timestamp
 
 
 
-    def get_zurfer_bots_data(bot, data):
-    
-        bt_data = data[["open","close"]].copy()
-        
-        hourly_bt_data = resample_1h(bt_data)
+    def get_zlema_begin_date(symbol, periods, most_recent_timestamp):
+        # The bar at most_recent_timestamp is the first one whose ZLEMA is needed
+        since = pytz.utc.localize(most_recent_timestamp) if most_recent_timestamp is not None else None
 
-        hourly_bt_data["first_zlema"] = ta.zlma(hourly_bt_data["close"], length=bot["first_zlema_period"])
-        hourly_bt_data["second_zlema"] = ta.zlma(hourly_bt_data["close"], length=bot["second_zlema_period"])
-        
-        hourly_bt_data = hourly_bt_data.dropna()
-        
-        # Individual condition vectors
-        price_above_first_zlema = hourly_bt_data["close"] > hourly_bt_data["first_zlema"]
-        price_above_second_zlema = hourly_bt_data["close"] > hourly_bt_data["second_zlema"]
-        first_zlema_above_price = hourly_bt_data["first_zlema"] > hourly_bt_data["close"]
-        second_zlema_above_price = hourly_bt_data["second_zlema"] > hourly_bt_data["close"]
-        second_zlema_above_first = hourly_bt_data["second_zlema"] > hourly_bt_data["first_zlema"]
-        first_zlema_above_second = hourly_bt_data["first_zlema"] > hourly_bt_data["second_zlema"]
-
-        # Combined conditions
-        if bot["condition"] == 0:
-            hourly_bt_data["position"] = first_zlema_above_price & second_zlema_above_price
-        elif bot["condition"] == 1:
-            hourly_bt_data["position"] = price_above_first_zlema & price_above_second_zlema
-        elif bot["condition"] == 2:  # P, 1, 2
-            hourly_bt_data["position"] = first_zlema_above_price & second_zlema_above_first
-        elif bot["condition"] == 3:  # 1, P, 2
-            hourly_bt_data["position"] = price_above_first_zlema & second_zlema_above_price
-        elif bot["condition"] == 4:  # 1, 2, P
-            hourly_bt_data["position"] = price_above_second_zlema & second_zlema_above_first
-        elif bot["condition"] == 5:  # P, 2, 1
-            hourly_bt_data["position"] = second_zlema_above_price & first_zlema_above_second
-        elif bot["condition"] == 6:  # 2, P, 1
-            hourly_bt_data["position"] = price_above_second_zlema & first_zlema_above_price
-        elif bot["condition"] == 7:  # 2, 1, P
-            hourly_bt_data["position"] = price_above_first_zlema & first_zlema_above_second
-        elif bot["condition"] == 8:  # 1, 2 (No Price Position Specified)
-            hourly_bt_data["position"] = second_zlema_above_first
-        elif bot["condition"] == 9:  # 2, 1 (No Price Position Specified)
-            hourly_bt_data["position"] = first_zlema_above_second
-
-        hourly_bt_data["position"] = hourly_bt_data["position"].shift(1).astype("bool")
-
-        return hourly_bt_data[["position"]].dropna()
+        # Without a stored state covering it, ZLEMA is recomputed from the start of the history
+        resume_date = zlema_engine.resume_date(symbol, periods, since)
+        if resume_date is None:
+            return pd.Timestamp("2017-01-01")
+        return resume_date.tz_localize(None)
 
     def get_zurfer_begin_date(zurfer_bot):
         # Check the database for the most recent timestamp
         most_recent_timestamp = get_bot_max_timestamp(zurfer_bot)
-        zlema_lookback = 4*max(
+        zlema_periods = [
             zurfer_bot["first_zlema_period"],
             zurfer_bot["second_zlema_period"],
-            )
+            ]
 
         # Calculate actual_begin_date based on strategy lookback
         if most_recent_timestamp is not None:
@@ -139,33 +81,12 @@ def run_bots():
                 return None, None
             
             print(f"Bot {zurfer_bot['bot_name']} is not up to date")
-            actual_begin_date = most_recent_timestamp - pd.Timedelta(hours=zlema_lookback)
-                
-        else:
-            actual_begin_date = pd.Timestamp("2017-01-01")
-
-        return actual_begin_date, most_recent_timestamp
-
-
 
-    def get_random_bots_data(random_bot, data):
-        bt_data = data[["open", "close"]].copy()
-        hourly_bt_data = resample_1h(bt_data)
+        actual_begin_date = get_zlema_begin_date(zurfer_bot["symbol"], zlema_periods, most_recent_timestamp)
 
-        def generate_random_boolean(last_close_price):
-            # Using the last close price in combination with the symbol and seed for random generation
-            random.seed(last_close_price + hash(random_bot["symbol"]) + random_bot["seed"])
-            return random.choice([True, False])
-
-        # Get the last close price for each period in the hourly data
-        last_close_prices = hourly_bt_data["close"]
-
-        # Apply the function to these last close prices
-        random_booleans = last_close_prices.apply(generate_random_boolean)
+        return actual_begin_date, most_recent_timestamp
 
-        hourly_bt_data["position"] = random_booleans
 
-        return hourly_bt_data[["position"]].shift(1).astype("bool").dropna()
 
     def get_random_begin_date(random_bot):
         most_recent_timestamp = get_bot_max_timestamp(random_bot)
@@ -178,94 +99,68 @@ def run_bots():
 
 
     def get_bot_max_timestamp(bot):
+        return bot_max_timestamps.get(bot["bot_name"])
+
+    def get_bot_max_timestamps(bot_names):
+        # One round trip for every bot, each MAX is an index-only descent of ix_bots_bot_name_timestamp
         sql_query = text(
-            f"SELECT MAX(timestamp) as most_recent_timestamp "
-            f"FROM bots "
-            f"WHERE bot_name = :bot_name"
+            "SELECT names.bot_name, "
+            "(SELECT MAX(timestamp) FROM bots WHERE bots.bot_name = names.bot_name) AS most_recent_timestamp "
+            "FROM unnest(CAST(:bot_names AS text[])) AS names(bot_name)"
         )
 
         with engine.connect() as connection:
-            result = connection.execute(sql_query, {"bot_name": bot["bot_name"]})
-            most_recent_timestamp = result.scalar()
-        
-        return most_recent_timestamp
-
+            result = connection.execute(sql_query, {"bot_names": list(bot_names)})
+            return {row.bot_name: row.most_recent_timestamp for row in result}
 
 
-    data_dict = {}
 
     def load_symbol_data(symbol, begin_date):
         print("Loading bot's data")
+        begin_date = pd.Timestamp(begin_date).tz_localize('UTC')
 
-        # Define the timestamp for tomorrow at 1 AM
-        tomorrow_1_am = pd.Timestamp(datetime.now().replace(hour=1, minute=0, second=0, microsecond=0) + timedelta(days=1)).tz_localize('UTC')
+        if symbol in price_store and price_store.first(symbol) <= begin_date:
+            return price_store.frame(symbol, begin_date)
 
-        # Determine the date range for fetching data
-        if symbol not in data_dict:
-            # If no data is available, fetch from begin_date to tomorrow 1 AM
-            data_to_fetch_from = pd.Timestamp(begin_date).tz_localize('UTC')
-            fetch_up_to = tomorrow_1_am
+        if price_cache is not None:
+            # The local cache holds the whole history, only the delta is read remotely
+            with engine.connect() as connection:
+                parts = price_cache.sync(connection, symbol, begin_date)
         else:
-            if data_dict[symbol].index.min() <= pd.Timestamp(begin_date).tz_localize('UTC'):
-                return data_dict[symbol]
-            # If data is available but not enough, fetch from begin_date to the oldest data available
-            data_to_fetch_from = pd.Timestamp(begin_date).tz_localize('UTC')
-            fetch_up_to = data_dict[symbol].index.min()
-
-        # Fetch data from the database
-        with engine.connect() as connection:
-            fetch_data_query = text("""
-                SELECT timestamp, open, close 
-                FROM market_data 
-                WHERE symbol = :symbol AND timestamp >= :data_to_fetch_from AND timestamp < :fetch_up_to
-            """)
-
-            new_data = pd.read_sql_query(fetch_data_query, connection, params={"symbol": symbol, "data_to_fetch_from": data_to_fetch_from, "fetch_up_to": fetch_up_to})
+            # Define the timestamp for tomorrow at 1 AM
+            tomorrow_1_am = pd.Timestamp(datetime.now().replace(hour=1, minute=0, second=0, microsecond=0) + timedelta(days=1)).tz_localize('UTC')
 
-        # Process the fetched data
-        if not new_data.empty:
-            new_data.set_index('timestamp', inplace=True)
-            new_data.index = new_data.index.tz_localize('UTC')  # Ensure timestamps are timezone-aware
+            with engine.connect() as connection:
+                parts = [read_prices(connection, "market_data_1h", symbol, begin_date, tomorrow_1_am)]
 
-            # Combine new data with existing data if available and remove duplicates
-            final_df = pd.concat([data_dict.get(symbol, pd.DataFrame()), new_data])
+        # Written once into buffers of the exact size, the store evicts other symbols past its budget
+        price_store.put(symbol, parts)
+        return price_store.frame(symbol)
 
-            if not final_df.index.is_monotonic_increasing:
-                final_df.sort_index(inplace=True)
-
-            data_dict[symbol] = final_df
+    engine = get_engine()
+    github_token = os.environ.get('githubtoken')
 
-            return final_df
-        else:
-            print("Data already available")
-            return data_dict.get(symbol, None)
+    price_cache_dir = os.environ.get('pricecachedir', 'price_cache')
+    price_cache = PriceCache(price_cache_dir) if price_cache_dir else None
 
-    load_dotenv()
-    database_password = os.environ.get('password')
-    server_address = os.environ.get('serverip')
-    github_token = os.environ.get('githubtoken')
-    connection_string = f"postgresql://postgres:{database_password}@{server_address}:5432/postgres"
-    engine = create_engine(connection_string, echo=False)
+    price_store = PriceStore(
+        int(os.environ.get('pricestoremb', 512)) * 1024 * 1024,
+        dtype=os.environ.get('pricestoredtype', 'float64'),
+    )
 
-    headers = {
-        'Authorization': f'token {github_token}',
-        'Accept': 'application/vnd.github.v3.raw'
-    }
-    zurfer_bots_config_url = 'https://api.github.com/repos/mendoncaDS/zlema_bots_config/contents/bots_config.json?ref=main'
-    zurfer_bots_response = requests.get(zurfer_bots_config_url, headers=headers)
-    
-    if zurfer_bots_response.ok:
-        zurfer_bots_list = json.loads(zurfer_bots_response.text)
-    else:
-        # Handle errors here
-        print('Could not fetch the file:', zurfer_bots_response.status_code)
+    indicator_cache = IndicatorCache(int(os.environ.get('indicatorcachemb', 256)) * 1024 * 1024)
+    with engine.begin() as connection:
+        zlema_engine = ZlemaEngine.load(connection, indicator_cache)
+    zlema_verify = os.environ.get('zlemaverify', '').lower() in ('1', 'true', 'yes')
+    bot_workers = int(os.environ.get('botworkers', 1))
 
+    zurfer_bots_list = load_bots_config(
+        os.environ.get('botsconfigurl') or DEFAULT_URL,
+        github_token,
+        os.environ.get('botsconfigcache', 'bots_config_cache/bots_config.json'),
+    )
 
-    strategy_name_mapping = {
-        "zurfer":get_zurfer_bots_data,
-        "zzurfer":get_zzurfer_bots_data,
-        "random":get_random_bots_data
-    }
+    bot_max_timestamps = get_bot_max_timestamps({bot["bot_name"] for bot in zurfer_bots_list})
 
     begin_date_mapping = {
         "zurfer":get_zurfer_begin_date,
@@ -274,9 +169,11 @@ def run_bots():
     }
 
 
-    bot_data_to_push = pd.DataFrame()
+    # Work out which bots need new positions and how much history each symbol needs
+    pending_bots = {}
+    begin_dates = {}
 
-    for zurfer_bot in zurfer_bots_list:
+    for i, zurfer_bot in enumerate(zurfer_bots_list):
         print("--------------------")
         print(f"Processing {zurfer_bot['bot_name']} bot")
         
@@ -285,34 +182,48 @@ def run_bots():
         if actual_begin_date is None:
             continue
 
-        # Load and filter symbol data
-        data = load_symbol_data(zurfer_bot["symbol"], actual_begin_date)
-
-        # Process the data
-        print(f"Running {zurfer_bot['strategy']} strategy")
-        bot_data = strategy_name_mapping.get(zurfer_bot["strategy"])(zurfer_bot, data)
-        
-        bot_data["position"] = bot_data["position"].astype(bool)
-
-        bot_data["bot_name"] = zurfer_bot["bot_name"]
-        bot_data["symbol"] = zurfer_bot["symbol"]
-        bot_data.index.name = "timestamp"
+        if zlema_verify:
+            # Verification compares against a recompute over the whole history
+            actual_begin_date = pd.Timestamp("2017-01-01")
 
-        bot_data.reset_index(inplace=True)
+        symbol = zurfer_bot["symbol"]
+        pending_bots.setdefault(symbol, []).append((i, {**zurfer_bot, "most_recent_timestamp": most_recent_timestamp}))
+        begin_dates[symbol] = min(begin_dates.get(symbol, actual_begin_date), actual_begin_date)
 
-        if most_recent_timestamp is not None:
-            most_recent_timestamp = pytz.utc.localize(most_recent_timestamp)
-            bot_data = bot_data[bot_data["timestamp"] > most_recent_timestamp]
-        
-        bot_data_to_push = pd.concat([bot_data_to_push, bot_data], ignore_index=True)
+    # Load each symbol once, every bot on it shares one hourly series. Built one symbol
+    # at a time: the serial path only holds the hourly series of the symbol being
+    # evaluated, evaluate_parallel keeps every symbol's in shared memory until the end
+    def iter_groups():
+        for symbol, bots in pending_bots.items():
+            data = load_symbol_data(symbol, begin_dates[symbol])
+            yield symbol, (bots, resample_1h(data))
 
-    # Update database if there is new data
-    if not bot_data_to_push.empty:
-        bot_data_to_push.to_sql('bots', con=engine, if_exists='append', index=False)
+    if bot_workers > 1 and len(pending_bots) > 1:
+        results = evaluate_parallel(iter_groups(), zlema_engine, zlema_verify, bot_workers)
+    else:
+        results = []
+        for symbol, (bots, hourly) in iter_groups():
+            results.extend(evaluate_symbol(bots, hourly, zlema_engine, zlema_verify))
+        results.sort(key=lambda result: result[0])
+
+    # A single concat at the end, concatenating inside the loop copies the frame once per bot
+    bot_frames = [bot_data for _, bot_data in results if not bot_data.empty]
+    bot_data_to_push = pd.concat(bot_frames, ignore_index=True) if bot_frames else pd.DataFrame()
+
+    # Update database if there is new data, together with the indicator states it was computed from
+    with engine.begin() as connection:
+        if not bot_data_to_push.empty:
+            copy_frame(connection, bot_data_to_push, 'bots', index=False)
+        zlema_engine.save(connection)
     
+    indicator_cache.log_stats()
+    price_store.log_stats()
+
     print("--------------------")
     print("Bots updated! (probably)")
 
+
+
 if __name__ == "__main__":
     run_bots()
 
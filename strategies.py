@@ -0,0 +1,126 @@
+
+import pytz
+
+import pandas as pd
+
+import metrics
+from zlema_engine import verify_zlema
+from random_positions import random_positions
+
+
+# Position rule of each zurfer condition code, as (above, below) pairs that must all hold
+ZURFER_CONDITIONS = {
+    0: [("first_zlema", "close"), ("second_zlema", "close")],
+    1: [("close", "first_zlema"), ("close", "second_zlema")],
+    2: [("first_zlema", "close"), ("second_zlema", "first_zlema")],  # P, 1, 2
+    3: [("close", "first_zlema"), ("second_zlema", "close")],  # 1, P, 2
+    4: [("close", "second_zlema"), ("second_zlema", "first_zlema")],  # 1, 2, P
+    5: [("second_zlema", "close"), ("first_zlema", "second_zlema")],  # P, 2, 1
+    6: [("close", "second_zlema"), ("first_zlema", "close")],  # 2, P, 1
+    7: [("close", "first_zlema"), ("first_zlema", "second_zlema")],  # 2, 1, P
+    8: [("second_zlema", "first_zlema")],  # 1, 2 (No Price Position Specified)
+    9: [("first_zlema", "second_zlema")],  # 2, 1 (No Price Position Specified)
+}
+
+
+def _since(bot):
+    most_recent_timestamp = bot.get("most_recent_timestamp")
+    return pytz.utc.localize(most_recent_timestamp) if most_recent_timestamp is not None else None
+
+
+def get_zlema(zlema_engine, bot, period, close, verify=False):
+    # Hours after the symbol's ingestion watermark are computed but never saved
+    zlema = zlema_engine.update(bot["symbol"], period, close, since=_since(bot))
+
+    if verify:
+        # In verify mode `close` starts at the beginning of the history
+        verify_zlema(zlema, close, period)
+
+    return zlema
+
+
+def get_zurfer_bots_data(bot, hourly, zlema_engine, verify=False):
+
+    hourly_bt_data = hourly.copy()
+
+    hourly_bt_data["first_zlema"] = get_zlema(zlema_engine, bot, bot["first_zlema_period"], hourly_bt_data["close"], verify)
+    hourly_bt_data["second_zlema"] = get_zlema(zlema_engine, bot, bot["second_zlema_period"], hourly_bt_data["close"], verify)
+
+    hourly_bt_data = hourly_bt_data.dropna()
+
+    # Only build the comparisons the bot's condition uses
+    position = None
+    for above, below in ZURFER_CONDITIONS[bot["condition"]]:
+        term = hourly_bt_data[above] > hourly_bt_data[below]
+        position = term if position is None else position & term
+    hourly_bt_data["position"] = position
+
+    hourly_bt_data["position"] = hourly_bt_data["position"].shift(1).astype("bool")
+
+    return hourly_bt_data[["position"]].dropna()
+
+
+def get_zzurfer_bots_data(bot, hourly, zlema_engine, verify=False):
+    zurfer_bot_1 = {
+        "symbol":bot["symbol"],
+        "most_recent_timestamp":bot.get("most_recent_timestamp"),
+        "first_zlema_period":bot["first_zlema_period"],
+        "second_zlema_period":bot["second_zlema_period"],
+        "condition":bot["condition"],
+    }
+    zurfer_1 = get_zurfer_bots_data(zurfer_bot_1, hourly, zlema_engine, verify)
+
+    zurfer_bot_2 = {
+        "symbol":bot["symbol"],
+        "most_recent_timestamp":bot.get("most_recent_timestamp"),
+        "first_zlema_period":bot["first_zlema_period_2"],
+        "second_zlema_period":bot["second_zlema_period_2"],
+        "condition":bot["condition_2"],
+    }
+    zurfer_2 = get_zurfer_bots_data(zurfer_bot_2, hourly, zlema_engine, verify)
+
+    zzurfer = pd.DataFrame()
+
+    zzurfer["position"] = zurfer_1["position"] | zurfer_2["position"]
+
+    return zzurfer.dropna()
+
+
+def get_random_bots_data(random_bot, hourly, zlema_engine=None, verify=False):
+    hourly_bt_data = hourly.copy()
+
+    # One vectorized draw for the whole column, keyed by symbol and seed
+    hourly_bt_data["position"] = random_positions(hourly_bt_data.index, random_bot["symbol"], random_bot["seed"])
+
+    return hourly_bt_data[["position"]].shift(1).astype("bool").dropna()
+
+
+strategy_name_mapping = {
+    "zurfer":get_zurfer_bots_data,
+    "zzurfer":get_zzurfer_bots_data,
+    "random":get_random_bots_data
+}
+
+
+def run_strategy(bot, hourly, zlema_engine, verify=False):
+    """
+    New positions of `bot` (a config entry plus its most_recent_timestamp)
+    in the layout of the bots table.
+    """
+    print(f"Running {bot['strategy']} strategy for {bot['bot_name']}")
+    with metrics.bot_compute_seconds.time(strategy=bot["strategy"]):
+        bot_data = strategy_name_mapping.get(bot["strategy"])(bot, hourly, zlema_engine, verify)
+
+    bot_data["position"] = bot_data["position"].astype(bool)
+
+    bot_data["bot_name"] = bot["bot_name"]
+    bot_data["symbol"] = bot["symbol"]
+    bot_data.index.name = "timestamp"
+
+    bot_data.reset_index(inplace=True)
+
+    since = _since(bot)
+    if since is not None:
+        bot_data = bot_data[bot_data["timestamp"] > since]
+
+    return bot_data
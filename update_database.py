@@ -3,88 +3,94 @@ import os
 import pytz
 import logging
 import datetime
-import threading
 
-import pandas as pd
-import vectorbt as vbt
-from run_bots import run_bots
+from bulk_write import copy_frame
+from kline_fetcher import binance_budget, binance_client, iter_kline_chunks, fetch_and_write
+from ingest_state import ensure_watermarks, get_resume_points, set_watermark
+from market_data_rollup import ensure_rollups, refresh_rollups
+from market_data_schema import ensure_partitions
 
-from flask import Flask
-from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+
+from db import get_engine
 
 
 
 
 def unique_symbol_freqs(engine):
     with engine.connect() as connection:
-        query = text(f"SELECT DISTINCT symbol FROM market_data")
+        query = text(f"SELECT DISTINCT symbol FROM market_data WHERE interval = '1m'")
         result  = connection.execute(query)
         unique_combinations = [row[0] for row in result.fetchall()]
     return unique_combinations
 
 
+def as_market_data(data, symbol):
+    """
+    Shape a chunk from iter_kline_chunks into market_data rows of
+    `symbol`, in place, ready for write_klines.
+    """
+    data.columns = ['open', 'high', 'low', 'close', 'volume']
+    data['symbol'] = symbol
+    data.index.name = 'timestamp'
+    return data
+
+
+def write_klines(engine, data):
+    """
+    Write a 1m market_data frame (one or more symbols) with its
+    watermarks and rollups in one transaction. Returns the number of rows
+    inserted.
+    """
+    with engine.begin() as connection:
+        ensure_partitions(connection, data.index.min(), data.index.max())
+        written = copy_frame(connection, data, 'market_data', index=True)
+        for symbol, rows in data.groupby("symbol"):
+            set_watermark(connection, symbol, "1m", rows.index.max())
+            refresh_rollups(connection, symbol, rows.index.min(), rows.index.max())
+    return written
+
+
 def update_database():
 
-    load_dotenv()
-    database_password = os.environ.get('password')
-    server_address = os.environ.get('serverip')
-    logging.info(f"Loaded dotenv values.")
-    connection_string = f"postgresql://postgres:{database_password}@{server_address}:5432/postgres"
     global engine
-    engine = create_engine(connection_string)
+    engine = get_engine()
     logging.info(f"Connected to database.")
 
-    all_data = []
-
     # Get the current timestamp at the beginning of the function
     end_timestamp = datetime.datetime.now(pytz.utc)
 
     symbol_freqs = unique_symbol_freqs(engine)
 
-    # Fetch the last_timestamps for all symbol_freq combinations
-    sql_query = text("""
-    SELECT symbol, MAX(timestamp) as last_timestamp
-    FROM market_data
-    GROUP BY symbol;
-    """)
-
     with engine.begin() as connection:
-        result = connection.execute(sql_query)
-        last_timestamps = {row.symbol: row.last_timestamp for row in result}
+        ensure_watermarks(connection)
+        ensure_rollups(connection)
+        last_timestamps = get_resume_points(connection, "1m")
     
     print(symbol_freqs)
 
-    for symbol in symbol_freqs:
-        print(f"symbol: {symbol}")
+    # A local stand-in of the API has no limit worth respecting
+    weight_per_minute = os.environ.get('binanceweightperminute')
+    budget = binance_budget(float(weight_per_minute) if weight_per_minute else None)
+    client = binance_client(os.environ.get('binanceapiurl'))
+    max_workers = int(os.environ.get('downloadworkers', 4))
 
+    def download_symbol(symbol):
         last_timestamp = last_timestamps.get((symbol))
-        if last_timestamp:
-            last_timestamp = pytz.utc.localize(last_timestamp)
 
-        downloadedData = vbt.BinanceData.download(
-            symbols=symbol,
+        chunks = iter_kline_chunks(
+            symbol,
             start=last_timestamp,
             end=end_timestamp,  # Using the end_timestamp here
-            interval="1m"
-        ).get(["Open", "High", "Low", "Close", "Volume"])
-
-        if downloadedData.shape[0] > 2:
-            downloadedData = downloadedData.iloc[1:-1]
-            downloadedData.columns = ['open', 'high', 'low', 'close', 'volume']
-            downloadedData['symbol'] = symbol
-            downloadedData.index.name = 'timestamp'
-        else:
-            print("Data is up to date.")
-            continue  # Skip to the next iteration
-
-        #all_data.append(downloadedData)
+            interval="1m",
+            budget=budget,
+            client=client,
+        )
 
-        with engine.begin() as connection:
-            downloadedData.to_sql('market_data', connection, if_exists='append', index=True)
+        for downloadedData in chunks:
+            yield as_market_data(downloadedData, symbol)
 
-    # Concatenate all the data frames
-    #all_data_df = pd.concat(all_data)
+    def write_symbol(symbol, downloadedData):
+        return write_klines(engine, downloadedData)
 
-    #with engine.begin() as connection:
-        #all_data_df.to_sql('market_data', connection, if_exists='append', index=True)
+    return fetch_and_write(symbol_freqs, download_symbol, write_symbol, max_workers=max_workers)
@@ -0,0 +1,302 @@
+
+import copy
+import math
+import logging
+
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from sqlalchemy import text
+
+import metrics
+from indicator_cache import IndicatorCache
+from ingest_state import ensure_watermarks, get_watermarks
+
+
+class ZlemaState:
+    """
+    Running state of pandas_ta's zlma (EMA of 2*close - close.shift(lag),
+    seeded with the SMA of the first `period` values) after `bars` bars.
+    `lagged` is the ring buffer of the last `lag` closes.
+    """
+
+    def __init__(self, period, timestamp=None, value=None, bars=0, seed_sum=0.0, seed_count=0, lagged=()):
+        self.period = int(period)
+        self.lag = int(0.5 * (self.period - 1))
+        self.alpha = 2.0 / (self.period + 1)
+        self.timestamp = timestamp
+        self.value = math.nan if value is None else float(value)
+        self.bars = int(bars)
+        self.seed_sum = float(seed_sum)
+        self.seed_count = int(seed_count)
+        self.lagged = deque(lagged, maxlen=self.lag) if self.lag else None
+
+    def step(self, close):
+        if self.lag == 0:
+            x = close
+        elif len(self.lagged) == self.lag:
+            x = 2 * close - self.lagged[0]
+        else:
+            x = math.nan
+        if self.lag:
+            self.lagged.append(close)
+
+        bar = self.bars
+        self.bars += 1
+
+        if bar < self.period:
+            if not math.isnan(x):
+                self.seed_sum += x
+                self.seed_count += 1
+            if bar == self.period - 1:
+                self.value = self.seed_sum / self.seed_count
+        else:
+            self.value = self.alpha * x + (1 - self.alpha) * self.value
+
+        return self.value
+
+
+class ZlemaEngine:
+    """
+    Incremental ZLEMA per (symbol, period) on hourly closes. States are
+    persisted in the indicator_state table, so each run only steps through
+    the bars added since the previous one.
+
+    Only hours whose 1m candles are all ingested, going by each symbol's
+    watermark, are stepped into the persisted states. Rewriting older
+    rows drops the states that include them (invalidate_states).
+    """
+
+    indicator = "zlema"
+    interval = "1h"
+
+    def __init__(self, states=None, cache=None, watermarks=None):
+        self.states = states or {}
+        # Last ingested 1m candle per symbol, UTC
+        self.watermarks = watermarks or {}
+        self.dirty = set()
+        # States as they were before this run advanced them, every series of
+        # the run is computed from these so cache evictions are harmless
+        self.snapshots = {}
+        self.cache = cache if cache is not None else IndicatorCache()
+
+    @classmethod
+    def load(cls, connection, cache=None):
+        ensure_indicator_state(connection)
+        ensure_watermarks(connection)
+        result = connection.execute(
+            text("""
+                SELECT symbol, period, timestamp, value, bars, seed_sum, seed_count, lagged
+                FROM indicator_state
+                WHERE indicator = :indicator AND interval = :interval
+                """),
+            {"indicator": cls.indicator, "interval": cls.interval},
+        )
+        states = {}
+        for row in result:
+            states[(row.symbol, row.period)] = ZlemaState(
+                row.period,
+                timestamp=pd.Timestamp(row.timestamp).tz_localize("UTC"),
+                value=row.value,
+                bars=row.bars,
+                seed_sum=row.seed_sum,
+                seed_count=row.seed_count,
+                lagged=row.lagged,
+            )
+        engine = cls(states, cache, get_watermarks(connection, "1m"))
+        # States saved past the ingested hours may hold the close of a partial hour, recompute them
+        for key in [key for key, state in states.items() if state.timestamp >= engine.complete_before(key[0])]:
+            del states[key]
+        return engine
+
+    def complete_before(self, symbol):
+        """
+        Start of the first hour of `symbol` whose 1m candles are not all
+        ingested yet. Without a watermark no hour is known to be complete.
+        """
+        watermark = self.watermarks.get(symbol)
+        if watermark is None:
+            return pd.Timestamp(0, tz="UTC")
+        return (pd.Timestamp(watermark) + pd.Timedelta(minutes=1)).floor("60min")
+
+    def resume_date(self, symbol, periods, since):
+        """
+        Earliest bar the hourly data has to start from so every period in
+        `periods` is known from `since` on, or None when any of them has to
+        be recomputed from the full history.
+        """
+        if since is None:
+            return None
+
+        timestamps = []
+        for period in periods:
+            state = self._base_state((symbol, int(period)))
+            if state is None or not _covers(state.timestamp, since):
+                return None
+            timestamps.append(state.timestamp)
+        return min(timestamps)
+
+    def _base_state(self, key):
+        if key not in self.snapshots:
+            state = self.states.get(key)
+            self.snapshots[key] = copy.deepcopy(state) if state is not None else None
+        return self.snapshots[key]
+
+    def update(self, symbol, period, close, since=None, complete_before=None):
+        """
+        ZLEMA of `close` (hourly, UTC index), NaN where it isn't known.
+
+        Starts from the stored state when it covers `since`, otherwise
+        recomputes from the first bar of `close`, which must then be the
+        start of the symbol's history. Bars at or after `complete_before`
+        (by default the first hour not fully ingested) are computed on a
+        copy and never persisted. Results are shared through the indicator
+        cache for the rest of the run.
+        """
+        if complete_before is None:
+            complete_before = self.complete_before(symbol)
+        key = (symbol, int(period))
+        cache_key = (symbol, self.interval, self.indicator, int(period))
+        index = close.index
+
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            computed, known_from = cached
+            if _covers(known_from, since) and computed.index[-1] >= index[-1]:
+                return computed.reindex(index)
+
+        state = self._base_state(key)
+        values = close.to_numpy(dtype=float)
+        out = np.full(len(values), np.nan)
+
+        if state is None or not _covers(state.timestamp, since):
+            state = ZlemaState(period)
+            start = 0
+            known_from = None
+        else:
+            state = copy.deepcopy(state)
+            start = index.searchsorted(state.timestamp, side="right")
+            if start > 0 and index[start - 1] == state.timestamp:
+                out[start - 1] = state.value
+            known_from = state.timestamp
+
+        metrics.zlema_bars.inc(len(values) - start)
+        persistent = state
+        for i in range(start, len(values)):
+            if state is persistent and index[i] >= complete_before:
+                state = copy.deepcopy(persistent)
+            out[i] = state.step(values[i])
+            if state is persistent:
+                persistent.timestamp = index[i]
+
+        if persistent.timestamp is not None:
+            self.states[key] = persistent
+            self.dirty.add(key)
+
+        zlema = pd.Series(out, index=index)
+        self.cache.put(cache_key, (zlema, known_from), zlema.memory_usage(index=True))
+        return zlema
+
+    def save(self, connection):
+        ensure_indicator_state(connection)
+        rows = []
+        for symbol, period in self.dirty:
+            state = self.states[(symbol, period)]
+            rows.append({
+                "symbol": symbol,
+                "indicator": self.indicator,
+                "interval": self.interval,
+                "period": period,
+                "timestamp": state.timestamp.tz_convert("UTC").tz_localize(None).to_pydatetime(),
+                "value": None if math.isnan(state.value) else state.value,
+                "bars": state.bars,
+                "seed_sum": state.seed_sum,
+                "seed_count": state.seed_count,
+                "lagged": list(state.lagged or ()),
+            })
+
+        if rows:
+            connection.execute(text("""
+                INSERT INTO indicator_state
+                    (symbol, indicator, interval, period, timestamp, value, bars, seed_sum, seed_count, lagged)
+                VALUES
+                    (:symbol, :indicator, :interval, :period, :timestamp, :value, :bars, :seed_sum, :seed_count, :lagged)
+                ON CONFLICT (symbol, indicator, interval, period) DO UPDATE
+                SET timestamp = EXCLUDED.timestamp,
+                    value = EXCLUDED.value,
+                    bars = EXCLUDED.bars,
+                    seed_sum = EXCLUDED.seed_sum,
+                    seed_count = EXCLUDED.seed_count,
+                    lagged = EXCLUDED.lagged
+                """), rows)
+
+        self.dirty.clear()
+
+
+def _covers(known_from, since):
+    if known_from is None:
+        return True
+    return since is not None and known_from <= since
+
+
+def invalidate_states(connection, symbol, since):
+    """
+    Drop the saved states of `symbol` that already include the hour of
+    `since` (naive UTC or tz-aware), so the next run recomputes them from
+    the rows written there. Runs in the caller's transaction.
+    """
+    since = pd.Timestamp(since)
+    if since.tzinfo is not None:
+        since = since.tz_convert("UTC").tz_localize(None)
+
+    ensure_indicator_state(connection)
+    result = connection.execute(
+        text("DELETE FROM indicator_state WHERE symbol = :symbol AND interval = :interval AND timestamp >= :since"),
+        {"symbol": symbol, "interval": ZlemaEngine.interval, "since": since.floor("60min").to_pydatetime()},
+    )
+    if result.rowcount:
+        logging.info(f"Dropped {result.rowcount} indicator states of {symbol} from {since} on, rows there were rewritten.")
+
+
+def ensure_indicator_state(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS indicator_state (
+            symbol VARCHAR NOT NULL,
+            indicator VARCHAR NOT NULL,
+            interval VARCHAR NOT NULL,
+            period INTEGER NOT NULL,
+            timestamp TIMESTAMP NOT NULL,
+            value DOUBLE PRECISION,
+            bars BIGINT NOT NULL,
+            seed_sum DOUBLE PRECISION NOT NULL,
+            seed_count INTEGER NOT NULL,
+            lagged DOUBLE PRECISION[] NOT NULL,
+            PRIMARY KEY (symbol, indicator, interval, period)
+        )
+        """))
+
+
+def verify_zlema(incremental, close, period, tolerance=1e-8):
+    """
+    Compare incremental ZLEMA values against a full pandas_ta.zlma
+    recompute over `close` (the symbol's whole hourly history). Returns
+    the largest relative difference over the bars both have.
+    """
+    import pandas_ta as ta
+
+    full = ta.zlma(close, length=period, talib=False)
+    if full is None:
+        return 0.0
+
+    both = pd.concat([incremental.rename("incremental"), full.rename("full")], axis=1, join="inner").dropna()
+    if both.empty:
+        return 0.0
+
+    difference = ((both["incremental"] - both["full"]).abs() / both["full"].abs().clip(lower=1e-12)).max()
+    if difference > tolerance:
+        logging.warning(f"ZLEMA {period} differs from pandas_ta by {difference:.3g} (relative)")
+    else:
+        logging.info(f"ZLEMA {period} matches pandas_ta over {len(both)} bars ({difference:.3g})")
+    return difference
@@ -0,0 +1,197 @@
+
+import math
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+
+from strategies import ZURFER_CONDITIONS
+
+
+HOURS_PER_YEAR = 24 * 365
+
+# Pairs evaluated together, bounds the (pairs, bars) matrices to a few hundred MB on long histories
+PAIRS_PER_BLOCK = 256
+
+
+def zlema_matrix(close, periods):
+    """
+    ZLEMA of `close` for every period at once, as a (len(periods), bars)
+    float array with NaN where it isn't known yet. Same recurrence and
+    seeding as ZlemaState (pandas_ta's zlma), but each bar advances all
+    periods with one vector operation.
+    """
+    close = np.asarray(close, dtype=np.float64)
+    periods = np.asarray(periods, dtype=np.int64)
+    bars = len(close)
+    lags = (0.5 * (periods - 1)).astype(np.int64)
+    alphas = 2.0 / (periods + 1)
+
+    # x = 2 * close - close lagged, unknown for the first `lag` bars
+    positions = np.arange(bars)[None, :] - lags[:, None]
+    x = 2 * close[None, :] - close[np.clip(positions, 0, None)]
+    x[positions < 0] = np.nan
+
+    # SMA seed over the known values of the first `period` bars
+    seed_sums = np.nancumsum(x, axis=1)
+    seed_counts = np.cumsum(~np.isnan(x), axis=1)
+    rows = np.arange(len(periods))
+    seed_at = np.minimum(periods - 1, bars - 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        seeds = seed_sums[rows, seed_at] / seed_counts[rows, seed_at]
+
+    out = np.full((len(periods), bars), np.nan)
+    if bars == 0:
+        return out
+
+    value = np.full(len(periods), np.nan)
+    for t in range(int(periods.min()) - 1, bars):
+        value = np.where(t >= periods, alphas * x[:, t] + (1 - alphas) * value, value)
+        value = np.where(t == periods - 1, seeds, value)
+        out[:, t] = value
+    return out
+
+
+def _signals(first, second, close, condition):
+    terms = {"first_zlema": first, "second_zlema": second, "close": close}
+    signal = None
+    for above, below in ZURFER_CONDITIONS[condition]:
+        term = terms[above] > terms[below]
+        signal = term if signal is None else signal & term
+    return signal
+
+
+def _stats(held, log_returns, fee):
+    """
+    Per-row PnL statistics of a (rows, bars) boolean matrix of held
+    positions against per-bar log returns.
+    """
+    rows, bars = held.shape
+    if bars == 0:
+        return {name: np.zeros(rows) for name in ("total_return", "max_drawdown", "sharpe", "exposure", "trades")}
+
+    changes = held.copy()
+    changes[:, 1:] ^= held[:, :-1]
+
+    # float32 halves the memory traffic of the running sums, plenty for hourly log returns
+    strategy = held * log_returns.astype(np.float32)
+    if fee:
+        strategy -= changes * np.float32(-math.log(1 - fee))
+
+    equity = np.cumsum(strategy, axis=1)
+    total = equity[:, -1].astype(np.float64)
+    mean = total / bars
+    variance = np.einsum("ij,ij->i", strategy, strategy) / bars - mean ** 2
+    std = np.sqrt(np.maximum(variance, 0.0))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sharpe = np.where(std > 0, mean / std * math.sqrt(HOURS_PER_YEAR), np.nan)
+
+    # Running peak of the equity curve, reusing the strategy buffer
+    peak = np.maximum(equity, 0.0, out=strategy)
+    np.maximum.accumulate(peak, axis=1, out=peak)
+    drawdown = np.max(peak - equity, axis=1).astype(np.float64)
+
+    return {
+        "total_return": np.expm1(total),
+        "max_drawdown": -np.expm1(-drawdown),
+        "sharpe": sharpe,
+        "exposure": np.count_nonzero(held, axis=1) / bars,
+        "trades": np.count_nonzero(changes & held, axis=1),
+    }
+
+
+def sweep(hourly, first_periods, second_periods, conditions=None, fee=0.0, keep_positions=False,
+          pairs_per_block=PAIRS_PER_BLOCK):
+    """
+    Backtest every (first_zlema_period, second_zlema_period, condition)
+    combination of the zurfer strategy on one symbol's `hourly` frame.
+
+    Each distinct period's ZLEMA is computed once. Comparisons are then
+    evaluated for blocks of period pairs as (pairs, bars) boolean
+    matrices, one per condition. As in the live bot, the position held
+    during a bar is the signal of the bar before, and nothing is held
+    until both ZLEMAs are known. `fee` is charged (as a fraction) on
+    every position change.
+
+    Returns a DataFrame of statistics per combination and, with
+    `keep_positions`, a (combinations, bars) boolean matrix of held
+    positions in the same row order.
+    """
+    conditions = sorted(ZURFER_CONDITIONS) if conditions is None else list(conditions)
+    close = hourly["close"].to_numpy(dtype=np.float64)
+
+    periods = np.unique(np.concatenate([np.asarray(first_periods), np.asarray(second_periods)]).astype(np.int64))
+    zlemas = zlema_matrix(close, periods)
+    row_of = {int(period): i for i, period in enumerate(periods)}
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        log_returns = np.diff(np.log(close), prepend=np.nan)
+    log_returns = np.nan_to_num(log_returns, nan=0.0, posinf=0.0, neginf=0.0)
+
+    pairs = [(int(a), int(b)) for a in first_periods for b in second_periods]
+    results = []
+    positions = []
+
+    for block_start in range(0, len(pairs), pairs_per_block):
+        block = pairs[block_start:block_start + pairs_per_block]
+        first = zlemas[[row_of[a] for a, _ in block]]
+        second = zlemas[[row_of[b] for _, b in block]]
+        known = ~(np.isnan(first) | np.isnan(second))
+
+        for condition in conditions:
+            with np.errstate(invalid="ignore"):
+                signal = _signals(first, second, close[None, :], condition) & known
+            held = np.zeros_like(signal)
+            held[:, 1:] = signal[:, :-1]
+
+            stats = _stats(held, log_returns, fee)
+            for i, (a, b) in enumerate(block):
+                results.append({
+                    "first_zlema_period": a,
+                    "second_zlema_period": b,
+                    "condition": condition,
+                    **{name: values[i] for name, values in stats.items()},
+                })
+            if keep_positions:
+                positions.append(held)
+
+    table = pd.DataFrame(results)
+    if not keep_positions:
+        return table
+
+    # Rows above are ordered block by block, condition by condition
+    matrix = np.concatenate(positions) if positions else np.zeros((0, len(close)), dtype=bool)
+    return table, matrix
+
+
+def _period_range(spec):
+    start, stop, step = (int(part) for part in spec.split(":"))
+    return list(range(start, stop + 1, step))
+
+
+if __name__ == '__main__':
+    from db import get_engine
+    from pg_binary import read_prices
+    from hourly_resample import resample_hourly
+
+    parser = argparse.ArgumentParser(description="Sweep zurfer ZLEMA periods and conditions over one symbol")
+
+    parser.add_argument('-symbol', required=True, help='Symbol to backtest')
+    parser.add_argument('-first', required=False, default="5:100:5", help='First ZLEMA periods as start:stop:step')
+    parser.add_argument('-second', required=False, default="10:300:10", help='Second ZLEMA periods as start:stop:step')
+    parser.add_argument('-fee', required=False, type=float, default=0.001, help='Fee per position change')
+    parser.add_argument('-top', required=False, type=int, default=20, help='Combinations to print')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    with get_engine().connect() as connection:
+        columns = read_prices(connection, "market_data_1h", args.symbol)
+    index = pd.DatetimeIndex(columns["timestamp"].view("datetime64[ns]")).tz_localize("UTC")
+    # Same hourly series the bots are run on
+    hourly = resample_hourly(pd.DataFrame({"open": columns["open"], "close": columns["close"]}, index=index))
+
+    table = sweep(hourly, _period_range(args.first), _period_range(args.second), fee=args.fee)
+    print(table.sort_values("sharpe", ascending=False).head(args.top).to_string(index=False))